@@ -0,0 +1,50 @@
+"""
+Measures fan-in and fan-out through a Channel: a thousand producer green
+threads send to a thousand consumer green threads over a single Channel, for
+a range of buffer sizes::
+
+    python benchmarks/channel.py [items per producer] [producers/consumers]
+"""
+import time
+import sys
+
+import vanilla
+
+
+def fan(h, size, n, width):
+    ch = h.channel(size)
+    done = h.channel(width)
+
+    def produce():
+        for i in xrange(n):
+            ch.send(i)
+
+    def consume():
+        for _ in xrange(n):
+            ch.recv()
+        done.send(True)
+
+    for _ in xrange(width):
+        h.spawn(produce)
+        h.spawn(consume)
+
+    for _ in xrange(width):
+        done.recv()
+
+
+def main(n, width):
+    print('%-10s %-10s %10s %12s' % ('size', 'items', 'seconds', 'items/s'))
+    for size in [0, 16, 1024]:
+        h = vanilla.Hub()
+        fan(h, size, 10, width)
+        start = time.time()
+        fan(h, size, n, width)
+        took = time.time() - start
+        total = n * width
+        print('%-10s %-10s %10.3f %12d' % (size, total, took, total / took))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
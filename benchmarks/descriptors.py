@@ -0,0 +1,102 @@
+"""
+Compares waking green threads blocked on file descriptors with
+`Hub.wait_readable` against the Pipe based `Hub.register`.
+
+A green thread is parked on each of *n* registered sockets. Each round writes
+a byte to a random batch of them and waits for every reader in the batch to
+wake up and consume it::
+
+    python benchmarks/descriptors.py [sockets]
+
+Two file descriptors are needed per registered socket, so the open file limit
+is raised if possible.
+"""
+import resource
+import random
+import socket
+import time
+import sys
+
+import vanilla
+import vanilla.poll
+
+
+ROUNDS = 20
+BATCH = 1000
+
+
+def wait(h, conn, done):
+    fd = conn.fileno()
+    done.append(fd)
+    while True:
+        try:
+            h.wait_readable(fd)
+        except vanilla.Halt:
+            return
+        conn.recv(16)
+        done.append(fd)
+
+
+def register(h, conn, done):
+    recver = h.register(conn.fileno(), vanilla.poll.POLLIN)
+    done.append(conn.fileno())
+    for _ in recver:
+        conn.recv(16)
+        done.append(conn.fileno())
+
+
+def run(f, n):
+    h = vanilla.Hub()
+    pairs = []
+    for _ in xrange(n):
+        conn, other = socket.socketpair()
+        conn.setblocking(0)
+        pairs.append((conn, other))
+
+    done = []
+    start = time.time()
+    for conn, _ in pairs:
+        h.spawn(f, h, conn, done)
+    # let every reader park
+    while len(done) < n:
+        h.sleep(0)
+    setup = time.time() - start
+
+    random.seed(n)
+    start = time.time()
+    for _ in xrange(ROUNDS):
+        del done[:]
+        batch = random.sample(pairs, min(BATCH, n))
+        for _, other in batch:
+            other.send('x')
+        while len(done) < len(batch):
+            h.sleep(0)
+    took = time.time() - start
+
+    for conn, other in pairs:
+        h.unregister(conn.fileno())
+        conn.close()
+        other.close()
+    return setup, took
+
+
+def main(n):
+    want = 2 * n + 64
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < want:
+        soft = want if hard == resource.RLIM_INFINITY else min(want, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    if soft < want:
+        n = (soft - 64) / 2
+        print('open file limit is %s: only using %s sockets' % (soft, n))
+
+    print('%-10s %9s %9s %9s %12s' % (
+        'kind', 'sockets', 'setup', 'rounds', 'wakeups/s'))
+    for f in [wait, register]:
+        setup, took = run(f, n)
+        print('%-10s %9d %8.3fs %8.3fs %12d' % (
+            f.__name__, n, setup, took, ROUNDS * min(BATCH, n) / took))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
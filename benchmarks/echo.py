@@ -0,0 +1,81 @@
+"""
+Compares the epoll (or kqueue) based Poll with the io_uring based Uring
+poller, running the tcp echo example.
+
+A server echoes everything it receives, as in examples/tcp-echo.py but with
+a green thread per connection, and a number of clients on the same Hub each
+make a series of request / response round trips. Throughput is round trips
+per second across all clients, and latency is measured per round trip.
+Both pollers are readiness based, and run to run noise is larger than the
+difference between them::
+
+    python benchmarks/echo.py [clients] [round trips per client]
+"""
+import time
+import sys
+
+import vanilla
+import vanilla.poll
+
+
+POLLERS = [
+    ('poll', vanilla.poll.Poll),
+    ('uring', vanilla.poll.Uring), ]
+
+
+def run(poll, clients, n):
+    h = vanilla.Hub(poll=poll)
+    server = h.tcp.listen()
+
+    def echo(conn):
+        for data in conn.recver:
+            conn.send(data)
+
+    @h.spawn
+    def accept():
+        for conn in server:
+            h.spawn(echo, conn)
+
+    latencies = []
+    done = h.router()
+
+    def client(conn):
+        for _ in xrange(n):
+            start = time.time()
+            conn.send('x' * 64)
+            conn.recv()
+            latencies.append(time.time() - start)
+        done.send(True)
+
+    conns = [h.tcp.connect(server.port) for _ in xrange(clients)]
+    start = time.time()
+    for conn in conns:
+        h.spawn(client, conn)
+    for _ in xrange(clients):
+        done.recv()
+    took = time.time() - start
+
+    h.stop()
+    latencies.sort()
+    return took, latencies
+
+
+def main(clients, n):
+    print('%-6s %8s %8s %12s %9s %9s' % (
+        'poll', 'clients', 'trips', 'trips/s', 'p50 us', 'p99 us'))
+    for name, poll in POLLERS:
+        try:
+            took, latencies = run(poll, clients, n)
+        except OSError, e:
+            print('%-6s unavailable: %s' % (name, e))
+            continue
+        print('%-6s %8d %8d %12d %9d %9d' % (
+            name, clients, clients * n, clients * n / took,
+            latencies[len(latencies) / 2] * 1e6,
+            latencies[len(latencies) * 99 / 100] * 1e6))
+
+
+if __name__ == '__main__':
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200)
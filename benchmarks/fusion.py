@@ -0,0 +1,40 @@
+"""
+Measures the per item cost of a chain of map stages, fused onto a single
+green thread, against the same chain with a green thread for every stage::
+
+    python benchmarks/fusion.py [messages]
+"""
+import time
+import sys
+
+import vanilla
+
+
+def run(h, n, length, fuse):
+    sender, recver = h.pipe()
+    for _ in xrange(length):
+        recver = recver.map(lambda x: x + 1, fuse=fuse)
+
+    @h.spawn
+    def _():
+        for i in xrange(n):
+            sender.send(i)
+
+    for i in xrange(n):
+        recver.recv()
+
+
+def main(n):
+    print('%-8s %-8s %10s %12s' % ('stages', 'fused', 'seconds', 'us/item'))
+    for length in [1, 2, 5, 10]:
+        for fuse in [False, True]:
+            h = vanilla.Hub()
+            start = time.time()
+            run(h, n, length, fuse)
+            took = time.time() - start
+            print('%-8s %-8s %10.3f %12.2f' % (
+                length, fuse, took, took / n * 1000000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
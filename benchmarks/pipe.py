@@ -0,0 +1,77 @@
+"""
+Measures the cost of handing a message across a Pipe.
+
+Two green threads ping-pong a message back and forth over a pair of Pipes, so
+every message is a full send and recv handoff. Then a producer streams
+messages to a consumer, one at a time with send and recv, and in batches with
+send_many and recv_batch. Run it under each interpreter to compare, e.g.
+CPython and PyPy::
+
+    python benchmarks/pipe.py [messages]
+    pypy benchmarks/pipe.py [messages]
+"""
+import platform
+import time
+import sys
+
+import vanilla
+
+
+def pingpong(h, n):
+    ping = h.pipe()
+    pong = h.pipe()
+
+    @h.spawn
+    def _():
+        for item in ping.recver:
+            pong.send(item)
+
+    for i in xrange(n):
+        ping.send(i)
+        pong.recv()
+    ping.close()
+
+
+def stream(h, n):
+    p = h.pipe()
+
+    @h.spawn
+    def _():
+        for i in xrange(n):
+            p.send(i)
+
+    for i in xrange(n):
+        p.recv()
+
+
+def batched(h, n, size=64):
+    p = h.pipe()
+
+    @h.spawn
+    def _():
+        for i in xrange(0, n, size):
+            p.send_many(xrange(i, min(i + size, n)))
+
+    got = 0
+    while got < n:
+        got += len(p.recv_batch(size))
+
+
+def main(n):
+    print('%s %s' % (
+        platform.python_implementation(), platform.python_version()))
+    print('%-10s %-10s %10s %12s' % ('mode', 'messages', 'seconds', 'msgs/s'))
+    # each ping-pong round trip hands over two messages
+    for f, messages in [(pingpong, n * 2), (stream, n), (batched, n)]:
+        h = vanilla.Hub()
+        # warm up, which gives PyPy's JIT a chance to kick in
+        f(h, min(n, 10000))
+        start = time.time()
+        f(h, n)
+        took = time.time() - start
+        print('%-10s %-10s %10.3f %12d' % (
+            f.__name__, messages, took, messages / took))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,37 @@
+"""
+Measures throughput through a Queue, with a producer and a consumer green
+thread, for a range of buffer sizes::
+
+    python benchmarks/queue.py [items]
+"""
+import time
+import sys
+
+import vanilla
+
+
+def produce_consume(h, size, n):
+    q = h.queue(size)
+
+    @h.spawn
+    def _():
+        for i in xrange(n):
+            q.send(i)
+
+    for _ in xrange(n):
+        q.recv()
+
+
+def main(n):
+    print('%-10s %-10s %10s %12s' % ('size', 'items', 'seconds', 'items/s'))
+    for size in [1, 16, 256]:
+        h = vanilla.Hub()
+        produce_consume(h, size, min(n, 10000))
+        start = time.time()
+        produce_consume(h, size, n)
+        took = time.time() - start
+        print('%-10s %-10s %10.3f %12d' % (size, n, took, n / took))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,59 @@
+"""
+Compares the heap based Scheduler with the hierarchical TimingWheel.
+
+For each size, that many timers are added with delays spread over a minute,
+a fraction of them are cancelled before they fire (as happens with per
+connection timeouts that are satisfied), and the remainder are popped in due
+order::
+
+    python benchmarks/scheduler.py [size ...]
+"""
+import random
+import time
+import sys
+
+import vanilla.core
+
+
+SCHEDULERS = [
+    ('heap', vanilla.core.Scheduler),
+    ('wheel', vanilla.core.TimingWheel), ]
+
+CANCEL = [0.0, 0.5, 0.9]
+
+
+def run(Scheduler, delays, cancel):
+    s = Scheduler()
+
+    start = time.time()
+    items = [s.add(delay, None) for delay in delays]
+    added = time.time()
+
+    for item in items[:int(len(items) * cancel)]:
+        s.remove(item)
+    removed = time.time()
+
+    while s:
+        s.pop()
+    popped = time.time()
+
+    return added - start, removed - added, popped - removed
+
+
+def main(sizes):
+    print('%-6s %9s %7s %9s %9s %9s %9s' % (
+        'kind', 'timers', 'cancel', 'add', 'cancel', 'pop', 'us/timer'))
+
+    for size in sizes:
+        random.seed(size)
+        delays = [random.random() * 60000 for _ in xrange(size)]
+        for cancel in CANCEL:
+            for name, Scheduler in SCHEDULERS:
+                add, remove, pop = run(Scheduler, delays, cancel)
+                print('%-6s %9d %6d%% %8.3fs %8.3fs %8.3fs %9.2f' % (
+                    name, size, cancel * 100, add, remove, pop,
+                    (add + remove + pop) * 1e6 / size))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or [1000, 100000, 1000000])
@@ -0,0 +1,47 @@
+"""
+Compares Hub.select with a persistent Selector over many ends.
+
+A single green thread multiplexes over *ends* pipes, while one producer at a
+time sends on a random one, so every select has one ready end among many::
+
+    python benchmarks/selector.py [messages]
+"""
+import random
+import time
+import sys
+
+import vanilla
+
+
+def run(h, n, ends, persistent):
+    pipes = [h.pipe() for _ in xrange(ends)]
+    recvers = [recver for _, recver in pipes]
+
+    @h.spawn
+    def _():
+        for i in xrange(n):
+            random.choice(pipes).sender.send(i)
+
+    if persistent:
+        selector = h.selector(recvers)
+        for i in xrange(n):
+            selector.select()
+    else:
+        for i in xrange(n):
+            h.select(recvers)
+
+
+def main(n):
+    print('%-8s %-10s %10s %12s' % ('ends', 'select', 'seconds', 'msgs/s'))
+    for ends in [1, 10, 100, 1000]:
+        for persistent in [False, True]:
+            h = vanilla.Hub()
+            start = time.time()
+            run(h, n, ends, persistent)
+            took = time.time() - start
+            print('%-8s %-10s %10.3f %12d' % (
+                ends, persistent and 'selector' or 'hub', took, n / took))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,49 @@
+"""
+Measures the cost of spawning short lived green threads, with and without the
+Hub's worker pool.
+
+Each round spawns a batch of tasks which complete immediately, and a batch of
+tasks which block once on a pipe before completing, and then waits for all of
+them to finish::
+
+    python benchmarks/spawn.py [tasks]
+"""
+import time
+import sys
+
+import vanilla
+
+
+def immediate(h, n):
+    done = []
+    for _ in xrange(n):
+        h.spawn(done.append, True)
+    h.sleep(0)
+    while len(done) < n:
+        h.sleep(0)
+
+
+def blocking(h, n):
+    sender, recver = h.router()
+    for i in xrange(n):
+        h.spawn(sender.send, i)
+    for _ in xrange(n):
+        recver.recv()
+
+
+def main(n):
+    print('%-10s %-10s %10s %12s' % ('pool', 'tasks', 'seconds', 'spawns/s'))
+    for name, pool_size in [('none', 0), ('128', 128), ('unbounded', n)]:
+        for f in [immediate, blocking]:
+            h = vanilla.Hub(pool_size=pool_size)
+            # warm up the pool
+            f(h, min(n, 1000))
+            start = time.time()
+            f(h, n)
+            took = time.time() - start
+            print('%-10s %-10s %10.3f %12d' % (
+                name, f.__name__, took, n / took))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,98 @@
+"""
+Measures how long it takes a fresh process to get going with vanilla.
+
+For each module, a new interpreter is started which imports it. The report
+shows how long the import took and which of the slow to import standard
+library modules it pulled in along the way. Python 3.7+ can break this down
+further with `python -X importtime -c 'import vanilla.http'`.
+
+Finally the wall clock time is measured from starting a new interpreter to its
+first accepted tcp connection::
+
+    python benchmarks/startup.py [runs]
+"""
+import subprocess
+import socket
+import time
+import sys
+import os
+
+
+MODULES = [
+    'vanilla',
+    'vanilla.io',
+    'vanilla.tcp',
+    'vanilla.http',
+    'vanilla.process',
+    'vanilla.signal', ]
+
+HEAVY = [
+    'pkg_resources', 'ssl', 'hashlib', 'uuid', 'ctypes', 'urlparse', 'urllib']
+
+
+IMPORT = """
+import time
+start = time.time()
+import %s
+took = time.time() - start
+import sys
+print('%%s %%s' %% (took, ' '.join(
+    x for x in %r if sys.modules.get(x) is not None)))
+"""
+
+
+ACCEPT = """
+import vanilla
+h = vanilla.Hub()
+server = h.tcp.listen()
+print(server.port)
+import sys
+sys.stdout.flush()
+conn = server.recv()
+import time
+print(time.time())
+h.stop()
+"""
+
+
+def python(script):
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+    return subprocess.Popen(
+        [sys.executable, '-c', script], stdout=subprocess.PIPE, env=env)
+
+
+def imports(module, runs):
+    took = []
+    for _ in xrange(runs):
+        out = python(IMPORT % (module, HEAVY)).communicate()[0].split()
+        took.append(float(out[0]))
+    return min(took), out[1:]
+
+
+def accept(runs):
+    took = []
+    for _ in xrange(runs):
+        start = time.time()
+        p = python(ACCEPT)
+        port = int(p.stdout.readline())
+        conn = socket.create_connection(('127.0.0.1', port))
+        accepted = float(p.stdout.readline())
+        took.append(accepted - start)
+        p.wait()
+        conn.close()
+    return min(took)
+
+
+def main(runs):
+    print('%-16s %9s  %s' % ('module', 'import', 'heavy dependencies'))
+    for module in MODULES:
+        took, heavy = imports(module, runs)
+        print('%-16s %7.1fms  %s' % (module, took * 1000, ' '.join(heavy)))
+    print('')
+    print('first accepted connection: %.1fms' % (accept(runs) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
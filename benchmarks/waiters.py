@@ -0,0 +1,70 @@
+"""
+Measures how a Dealer and a Router scale with the number of green threads
+waiting on them. With N waiters, each waiter either times out, at a random
+point, so it has to be taken out of the middle of the waiting queue, or is
+dealt an item::
+
+    python benchmarks/waiters.py
+"""
+import random
+import time
+
+import vanilla
+
+
+def dealer_timeouts(h, n):
+    d = h.dealer()
+    done = h.channel(n)
+
+    def recv():
+        try:
+            d.recv(timeout=random.randint(1, 50))
+        except vanilla.Timeout:
+            done.send(True)
+
+    for _ in xrange(n):
+        h.spawn(recv)
+    for _ in xrange(n):
+        done.recv()
+
+
+def dealer_deal(h, n):
+    d = h.dealer()
+    done = h.channel(n)
+    for _ in xrange(n):
+        h.spawn(lambda: done.send(d.recv()))
+    h.sleep(1)
+    for i in xrange(n):
+        d.send(i)
+    for _ in xrange(n):
+        done.recv()
+
+
+def router_timeouts(h, n):
+    r = h.router()
+    done = h.channel(n)
+
+    def send():
+        try:
+            r.send(1, timeout=random.randint(1, 50))
+        except vanilla.Timeout:
+            done.send(True)
+
+    for _ in xrange(n):
+        h.spawn(send)
+    for _ in xrange(n):
+        done.recv()
+
+
+def main():
+    print('%-16s %-8s %10s' % ('mode', 'waiters', 'seconds'))
+    for f in [dealer_timeouts, dealer_deal, router_timeouts]:
+        for n in [100, 1000, 10000, 30000]:
+            h = vanilla.Hub()
+            start = time.time()
+            f(h, n)
+            print('%-16s %-8s %10.3f' % (f.__name__, n, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
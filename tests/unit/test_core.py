@@ -1,7 +1,19 @@
+import weakref
+import socket
+import random
+import math
 import time
+import sys
+import gc
+import os
+
+import greenlet
+import pytest
 
 import vanilla
 import vanilla.core
+import vanilla.poll
+import vanilla.io
 
 
 def test_lazy():
@@ -16,8 +28,11 @@ def test_lazy():
     assert c.now == want
 
 
-def test_Scheduler():
-    s = vanilla.core.Scheduler()
+@pytest.mark.parametrize('Scheduler', [
+    vanilla.core.Scheduler,
+    vanilla.core.TimingWheel, ])
+def test_Scheduler(Scheduler):
+    s = Scheduler(clock=lambda: 100.0)
     s.add(4, 'f2')
     s.add(9, 'f4')
     s.add(3, 'f1')
@@ -42,9 +57,93 @@ def test_Scheduler():
     assert not s
 
 
+@pytest.mark.parametrize('Scheduler', [
+    vanilla.core.Scheduler,
+    vanilla.core.TimingWheel, ])
+def test_Scheduler_clock(Scheduler):
+    now = [100.0]
+    s = Scheduler(clock=lambda: now[0])
+    s.add(10, 'f1')
+    assert s.timeout() == pytest.approx(0.01)
+    now[0] += 0.004
+    assert s.timeout() == pytest.approx(0.006)
+    now[0] += 0.01
+    assert s.timeout() < 0
+    assert s.pop() == ('f1', ())
+
+
+def test_monotonic():
+    want = vanilla.core.monotonic()
+    assert vanilla.core.monotonic() >= want
+
+
+class TestTimingWheel(object):
+    def test_order(self):
+        # spread timers across every level of the wheel, cancel a third and
+        # check the rest pop in due order
+        random.seed(0)
+        wheel = vanilla.core.TimingWheel(bits=2)
+        items = []
+        for i in xrange(300):
+            delay = random.choice([0, 1, 3, 17, 80, 500]) + random.random()
+            items.append(wheel.add(delay, i))
+
+        for item in items[::3]:
+            wheel.remove(item)
+        assert len(wheel) == 200
+
+        due = dict((item.action, item.due) for item in items)
+        got = [wheel.pop()[0] for _ in xrange(len(wheel))]
+        assert sorted(got) == [i for i in xrange(300) if i % 3]
+        assert [due[i] for i in got] == sorted(due[i] for i in got)
+        assert not wheel
+
+    def test_grow(self):
+        wheel = vanilla.core.TimingWheel(bits=2)
+        wheel.add(100, 'far')
+        wheel.add(2, 'near')
+        assert len(wheel.wheels) == 4
+        assert wheel.pop() == ('near', ())
+        assert 0.1 - wheel.timeout() < 0.001
+        assert wheel.pop() == ('far', ())
+        assert not wheel
+
+    def test_remove(self):
+        wheel = vanilla.core.TimingWheel()
+        item = wheel.add(5, 'f')
+        wheel.remove(item)
+        # removing twice is a no-op
+        wheel.remove(item)
+        assert len(wheel) == 0
+        assert not any(wheel.wheels)
+
+
+def test_Ready():
+    r = vanilla.core.Ready(weights=(2, 1, 1))
+    for i in xrange(4):
+        r.append(('low', i), vanilla.core.PRIORITY_LOW)
+        r.append(('normal', i))
+        r.append(('high', i), vanilla.core.PRIORITY_HIGH)
+    assert len(r) == 12
+    assert r.depths() == [4, 4, 4]
+
+    got = [r.popleft()[0] for _ in xrange(len(r))]
+    assert got == [
+        'high', 'high', 'normal', 'low',
+        'high', 'high', 'normal', 'low',
+        'normal', 'low',
+        'normal', 'low', ]
+    assert r.served == [4, 4, 4]
+    assert not r
+    pytest.raises(IndexError, r.popleft)
+
+
+@pytest.mark.parametrize('scheduler', [
+    vanilla.core.Scheduler,
+    vanilla.core.TimingWheel, ])
 class TestHub(object):
-    def test_spawn(self):
-        h = vanilla.Hub()
+    def test_spawn(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
         a = []
 
         h.spawn_later(10, lambda: a.append(1))
@@ -56,8 +155,8 @@ class TestHub(object):
         h.sleep(10)
         assert a == [2, 1]
 
-    def test_exception(self):
-        h = vanilla.Hub()
+    def test_exception(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
 
         def raiser():
             raise Exception()
@@ -69,11 +168,530 @@ class TestHub(object):
         h.sleep(1)
         assert a == [2]
 
+    def test_timeout(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
+        sender, recver = h.pipe()
+        h.spawn_later(20, sender.send, 1)
+        pytest.raises(vanilla.Timeout, recver.recv, timeout=10)
+        assert recver.recv(timeout=20) == 1
+        assert len(h.scheduled) == 0
+
+    def test_now(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
+        start = h.now()
+        # the clock is only sampled by the main loop
+        time.sleep(0.01)
+        assert h.now() == start
+        h.sleep(20)
+        assert h.now() - start >= 0.02
+
+    def test_stop(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
+
+        @h.spawn
+        def _():
+            h.sleep(20)
+
+        h.stop()
+
+
+@pytest.mark.parametrize('scheduler', [
+    vanilla.core.Scheduler,
+    vanilla.core.TimingWheel, ])
+class TestTimer(object):
+    def fake(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
+        clock = [100.0]
+        h.clock = lambda: clock[0]
+        h.update_time()
+
+        def advance(ms):
+            clock[0] += ms / 1000.0
+            h.update_time()
+            # run the next timer in place of the main loop
+            action, a = h.scheduled.pop()
+            action(*a)
+
+        return h, advance
+
+    def test_cancel(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
+        a = []
+
+        timer = h.spawn_later(10, a.append, 1)
+        assert timer.pending
+        assert timer.cancel()
+        assert not timer.pending
+        assert not timer.cancel()
+        assert len(h.scheduled) == 0
+
+        h.sleep(20)
+        assert a == []
+        h.stop()
+
+    def test_reschedule(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
+        a = []
+
+        timer = h.spawn_later(10, a.append, 1)
+        timer.reschedule(40)
+        h.sleep(20)
+        assert a == []
+        h.sleep(30)
+        assert a == [1]
+        assert not timer.pending
+        assert not timer.cancel()
+
+        # a fired timer can be armed again
+        timer.reschedule(10)
+        h.sleep(20)
+        assert a == [1, 1]
+
+    def test_every(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler)
+        a = []
+
+        def f():
+            a.append(1)
+            if len(a) == 3:
+                timer.cancel()
+
+        timer = h.every(5, f)
+        h.sleep(50)
+        assert a == [1, 1, 1]
+        assert len(h.scheduled) == 0
+        h.stop()
+
+    def test_fixed_rate(self, scheduler):
+        h, advance = self.fake(scheduler)
+        timer = h.every(10, lambda: None)
+        assert timer.item.due == pytest.approx(100.01)
+
+        # lateness doesn't accumulate
+        advance(13)
+        assert timer.item.due == pytest.approx(100.02)
+        assert timer.missed == 0
+
+        # runs which are a whole period late are skipped
+        advance(34)
+        assert timer.item.due == pytest.approx(100.05)
+        assert timer.missed == 2
+
+        timer.reschedule(5)
+        assert timer.item.due == pytest.approx(100.052)
+        advance(5)
+        assert timer.item.due == pytest.approx(100.062)
+
+    def test_fixed_delay(self, scheduler):
+        h, advance = self.fake(scheduler)
+        timer = h.every(10, lambda: None, fixed_rate=False)
+        advance(13)
+        assert timer.item.due == pytest.approx(100.023)
+        advance(34)
+        assert timer.item.due == pytest.approx(100.057)
+        assert timer.missed == 0
+
+    def test_coalesce(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler, slack=10)
+        h.time = 100.003
+        assert h.coalesce(3) == pytest.approx(7)
+        assert h.coalesce(7) == pytest.approx(7)
+        assert h.coalesce(8) == pytest.approx(17)
+        assert h.coalesce(3, slack=0) == 3
+        assert h.coalesce(3, slack=4) == pytest.approx(5)
+        assert h.coalesce(0) == 0
+
+    def test_slack(self, scheduler):
+        h = vanilla.Hub(scheduler=scheduler, slack=50)
+        a = []
+
+        # start on a window boundary, so the timers all fall in one window
+        h.time = math.floor(h.clock() / 0.05) * 0.05
+        for ms in [1, 3, 5, 7, 9]:
+            h.spawn_later(ms, a.append, ms)
+        h.sleep(60)
+        # all five timers fired in the same wakeup
+        assert a == [1, 3, 5, 7, 9]
+        assert h.stats()['coalesced'] == 4
+
+        # a timer can opt out
+        timer = h.spawn_later(1, a.append, 'now', slack=0)
+        assert timer.item.due == pytest.approx(h.now() + 0.001)
+
+
+def test_Descriptors():
+    d = vanilla.core.Descriptors(size=8)
+    assert not d
+    for fd in [3, 7, 8, 100]:
+        d.add(vanilla.core.Descriptor(fd))
+    assert len(d) == 4
+    # small fds are array indexed, large ones overflow
+    assert len(d.table) == 8
+    assert d.overflow.keys() == [8, 100] or d.overflow.keys() == [100, 8]
+    assert 7 in d
+    assert 5 not in d
+    assert d.get(100).fd == 100
+    assert sorted(x.fd for x in d.values()) == [3, 7, 8, 100]
+    assert d.pop(7).fd == 7
+    assert d.pop(100).fd == 100
+    assert d.pop(7) is None
+    assert len(d) == 2
+
+
+class TestWait(object):
+    def test_readable(self):
+        h = vanilla.Hub()
+        r, w = os.pipe()
+        vanilla.io.unblock(r)
+
+        pytest.raises(vanilla.Timeout, h.wait_readable, r, timeout=10)
+        assert not h.registered.get(r).waiting
+
+        h.spawn_later(10, os.write, w, 'x')
+        h.wait_readable(r)
+        assert os.read(r, 10) == 'x'
+
+        h.unregister(r)
+        assert not h.registered
+        os.close(r)
+        os.close(w)
+
+    def test_writable(self):
+        h = vanilla.Hub()
+        r, w = os.pipe()
+        vanilla.io.unblock(w)
+
+        # fill the pipe
+        while True:
+            try:
+                os.write(w, 'x' * 4096)
+            except OSError:
+                break
+        pytest.raises(vanilla.Timeout, h.wait_writable, w, timeout=10)
+
+        h.spawn(os.read, r, 65536)
+        h.wait_writable(w)
+        os.write(w, 'x')
+
+        h.unregister(w)
+        os.close(r)
+        os.close(w)
+
+    def test_latch(self):
+        # a slow reader is busy whenever the writer's data arrives, so it's
+        # never waiting when an edge is reported
+        h = vanilla.Hub()
+        r, w = socket.socketpair()
+        r.setblocking(0)
+        want = 'x' * 1000
+
+        @h.spawn
+        def _():
+            for i in xrange(200):
+                w.send(want)
+                if i % 10 == 0:
+                    h.sleep(1)
+
+        got = 0
+        while True:
+            while True:
+                try:
+                    got += len(r.recv(4096))
+                except socket.error:
+                    break
+            if got == len(want) * 200:
+                break
+            h.sleep(2)
+            h.wait_readable(r.fileno(), timeout=500)
+
+        h.unregister(r.fileno())
+        r.close()
+        w.close()
+
+    def test_register_latch(self):
+        h = vanilla.Hub()
+        r, w = os.pipe()
+        vanilla.io.unblock(r)
+        ready = h.register(r, vanilla.poll.POLLIN)
+
+        os.write(w, 'x')
+        # the event arrives while nothing is receiving
+        h.sleep(10)
+        assert ready.recv(timeout=100)
+        assert os.read(r, 10) == 'x'
+
+        h.unregister(r)
+        pytest.raises(vanilla.Closed, ready.recv)
+        os.close(r)
+        os.close(w)
+
+    def test_unregister(self):
+        h = vanilla.Hub()
+        r, w = os.pipe()
+        closed = []
+
+        h.watch(r, vanilla.poll.POLLIN).onclose(closed.append, r)
+        h.spawn_later(10, h.unregister, r)
+        pytest.raises(vanilla.Closed, h.wait_readable, r)
+        assert closed == [r]
+        assert not h.registered
+        os.close(r)
+        os.close(w)
+
     def test_stop(self):
         h = vanilla.Hub()
+        r, w = os.pipe()
+        closed = []
+
+        h.watch(w, vanilla.poll.POLLOUT).onclose(closed.append, w)
 
         @h.spawn
         def _():
-            h.sleep(20)
+            pytest.raises(vanilla.Stop, h.wait_readable, r)
+            closed.append(r)
 
         h.stop()
+        assert sorted(closed) == sorted([r, w])
+        assert not h.registered
+        os.close(r)
+        os.close(w)
+
+
+class TestPlugins(object):
+    def test_builtin(self):
+        h = vanilla.Hub()
+        assert h.io is h.io
+        assert vanilla.core.plugins.factories['io'] is vanilla.io.__plugin__
+
+    def test_miss(self, caplog):
+        h = vanilla.Hub()
+        assert not hasattr(h, 'nope')
+        assert 'nope' in vanilla.core.plugins.missing
+        assert not hasattr(h, 'nope')
+        # modules which aren't plugins are misses too
+        assert not hasattr(h, 'exception')
+        assert not caplog.records
+
+    def test_register(self, monkeypatch):
+        monkeypatch.setattr(vanilla.core, 'plugins', vanilla.core.Plugins())
+        vanilla.core.plugins.register('answer', lambda hub: 42)
+        h = vanilla.Hub()
+        assert h.answer == 42
+
+        def broken(hub):
+            raise Exception('oops')
+        vanilla.core.plugins.register('broken', broken)
+        with pytest.raises(AttributeError) as e:
+            h.broken
+        assert 'oops' in str(e.value)
+
+    def test_entry_points(self, monkeypatch, tmpdir):
+        tmpdir.join('plug.py').write('def factory(hub):\n    return 42\n')
+        tmpdir.mkdir('plug-1.0.dist-info').join('entry_points.txt').write(
+            '[vanilla.plugins]\n'
+            'answer = plug:factory\n'
+            'broken = plug:missing\n')
+        monkeypatch.setattr(sys, 'path', [str(tmpdir)] + sys.path)
+        monkeypatch.setattr(vanilla.core, 'plugins', vanilla.core.Plugins())
+
+        h = vanilla.Hub()
+        assert h.answer == 42
+
+        with pytest.raises(AttributeError) as e:
+            h.broken
+        assert 'missing' in str(e.value)
+        # failures are cached, rather than retried
+        sys.modules['plug'].missing = lambda hub: 1
+        pytest.raises(AttributeError, getattr, h, 'broken')
+        assert 'broken' in vanilla.core.plugins.failed
+        del sys.modules['plug']
+
+    def test_builtin_no_scan(self, monkeypatch):
+        monkeypatch.setattr(vanilla.core, 'plugins', vanilla.core.Plugins())
+        h = vanilla.Hub()
+        h.io
+        h.signal
+        # neither does a module named vanilla.<name> which isn't a plugin
+        assert not hasattr(h, 'exception')
+        assert vanilla.core.plugins.entry_points is None
+
+    def test_preload(self):
+        h = vanilla.Hub(preload=['io', 'tcp'])
+        assert 'io' in h.__dict__
+        assert 'tcp' in h.__dict__
+        pytest.raises(AttributeError, vanilla.Hub, preload=['nope'])
+
+
+class TestPool(object):
+    def test_reuse(self):
+        h = vanilla.Hub(pool_size=128)
+        got = []
+        h.spawn(lambda: got.append(greenlet.getcurrent()))
+        h.sleep(1)
+        h.spawn(lambda: got.append(greenlet.getcurrent()))
+        h.sleep(1)
+        assert got[0] is got[1]
+
+    def test_no_reuse(self):
+        h = vanilla.Hub(pool_size=0)
+        got = []
+        h.spawn(lambda: got.append(greenlet.getcurrent()))
+        h.sleep(1)
+        h.spawn(lambda: got.append(greenlet.getcurrent()))
+        h.sleep(1)
+        assert got[0] is not got[1]
+        assert not h.workers
+
+    def test_cap(self):
+        h = vanilla.Hub(pool_size=2)
+        for _ in xrange(5):
+            h.spawn(h.sleep, 10)
+        h.sleep(1)
+        assert len(h.workers) == 0
+        h.sleep(20)
+        assert len(h.workers) == 2
+
+    def test_release(self):
+        # a parked worker shouldn't keep its last task's arguments alive
+        h = vanilla.Hub(pool_size=128)
+
+        class Arg(object):
+            pass
+
+        arg = Arg()
+        ref = weakref.ref(arg)
+        h.spawn(lambda x: None, arg)
+        h.sleep(1)
+        del arg
+        gc.collect()
+        assert ref() is None
+
+    def test_stray_switch(self, caplog):
+        h = vanilla.Hub(pool_size=2)
+        h.spawn(lambda: None)
+        h.sleep(1)
+        worker, = h.workers
+        # a stray resume of a parked worker isn't run as a task
+        h.resume_later(worker, h.pipe().recver, 'item')
+        h.sleep(1)
+        assert h.workers == [worker]
+        got = []
+        h.spawn(got.append, 1)
+        h.sleep(1)
+        assert got == [1]
+        assert not caplog.records
+
+
+class TestPriority(object):
+    def test_spawn(self):
+        h = vanilla.Hub()
+        got = []
+        h.spawn(got.append, 'low', priority=vanilla.core.PRIORITY_LOW)
+        h.spawn(got.append, 'normal')
+        h.spawn(got.append, 'high', priority=vanilla.core.PRIORITY_HIGH)
+        h.sleep(1)
+        assert got == ['high', 'normal', 'low']
+
+    def test_starvation(self):
+        # a pair of high priority green threads ping ponging keep the ready
+        # queue busy. low priority work should still get a turn
+        h = vanilla.Hub()
+        got = []
+        sender, recver = h.pipe()
+
+        def ping():
+            for i in xrange(100):
+                sender.send(i)
+                got.append('high')
+
+        def pong():
+            for i in xrange(100):
+                recver.recv()
+
+        h.spawn(ping, priority=vanilla.core.PRIORITY_HIGH)
+        h.spawn(pong, priority=vanilla.core.PRIORITY_HIGH)
+        h.spawn(got.append, 'low', priority=vanilla.core.PRIORITY_LOW)
+        h.sleep(1)
+        assert len(got) == 101
+        assert got.index('low') < 50
+
+    def test_resume(self):
+        # green threads are resumed at the priority they were spawned with
+        h = vanilla.Hub()
+        got = []
+        sender, recver = h.router()
+
+        def send(name):
+            sender.send(name)
+            got.append(name)
+
+        h.spawn(send, 'low', priority=vanilla.core.PRIORITY_LOW)
+        h.spawn(send, 'high', priority=vanilla.core.PRIORITY_HIGH)
+        h.sleep(1)
+        assert h.stats()['ready'] == [0, 0, 0]
+
+        assert recver.recv() == 'high'
+        assert recver.recv() == 'low'
+        assert h.stats()['ready'] == [1, 0, 1]
+        h.sleep(1)
+        assert got == ['high', 'low']
+
+
+class TestBudget(object):
+    def test_yield(self):
+        h = vanilla.Hub()
+        got = []
+
+        def yielder(name):
+            for i in xrange(3):
+                got.append((name, i))
+                h.yield_()
+                assert not h.scheduled
+
+        h.spawn(yielder, 'a')
+        h.spawn(yielder, 'b')
+        h.sleep(0)
+        h.sleep(0)
+        h.sleep(0)
+        assert got == [
+            ('a', 0), ('b', 0), ('a', 1), ('b', 1), ('a', 2), ('b', 2)]
+
+    def test_batch_timers(self):
+        # all overdue timers fire together, before the ready tasks they
+        # create get to run
+        h = vanilla.Hub()
+        got = []
+
+        def fire(name):
+            got.append(name)
+            h.spawn(got.append, name.upper())
+
+        h.spawn_later(5, fire, 'a')
+        h.spawn_later(5, fire, 'b')
+        h.spawn_later(5, fire, 'c')
+        h.sleep(20)
+        assert got == ['a', 'b', 'c', 'A', 'B', 'C']
+
+    def test_io_not_starved(self):
+        h = vanilla.Hub(budget=10)
+        r, w = os.pipe()
+        recver = h.io.fd_in(r)
+        got = []
+
+        @h.spawn
+        def _():
+            got.append(recver.recv())
+
+        def busy():
+            for i in xrange(1000):
+                got.append(i)
+                h.yield_()
+
+        h.spawn(busy)
+        h.sleep(0)
+        os.write(w, 'io')
+        h.sleep(1)
+
+        assert 'io' in got
+        assert got.index('io') < 100
+        assert h.stats()['exhausted']
@@ -94,3 +94,24 @@ class TestIO(object):
         h.spawn(p.send, '12foo\n')
         assert p.recv_n(2) == '12'
         assert p.recv_line(2) == 'foo'
+
+    def test_slow_consumer(self):
+        # the reader's green thread is blocked handing data to the slow
+        # consumer as most of the writes arrive, so edges must be latched
+        h = vanilla.Hub()
+        sender, recver = h.io.pipe()
+
+        want = ''.join(chr(65 + i % 26) * 100 for i in xrange(2000))
+
+        @h.spawn
+        def _():
+            for i in xrange(0, len(want), 100):
+                sender.send(want[i:i+100])
+                if i % 5000 == 0:
+                    h.sleep(0)
+
+        got = ''
+        while len(got) < len(want):
+            got += recver.recv(timeout=500)
+            h.sleep(1)
+        assert got == want
@@ -72,6 +72,15 @@ class TestPipe(object):
         p = h.pipe()
         pytest.raises(vanilla.Stop, p.send, 1)
 
+    @pytest.mark.parametrize('primitive', ['pipe', 'dealer', 'router'])
+    def test_slots(self, primitive):
+        h = vanilla.Hub()
+        sender, recver = getattr(h, primitive)()
+        assert not hasattr(sender, '__dict__')
+        assert not hasattr(recver, '__dict__')
+        stream = vanilla.message.Stream(recver)
+        assert not hasattr(stream, '__dict__')
+
     def test_close_recver(self):
         h = vanilla.Hub()
 
@@ -227,6 +236,30 @@ class TestPipe(object):
         assert item == 10
         assert check.recv() == 'done'
 
+    def test_select_fair(self):
+        h = vanilla.Hub()
+        # buffered ends, kept full, are always ready
+        queues = [h.queue(2000) for _ in xrange(3)]
+        for q in queues:
+            q.send_many(xrange(2000))
+        recvers = [q.recver for q in queues]
+
+        def share(**kw):
+            served = [0] * len(recvers)
+            for _ in xrange(600):
+                end, _ = h.select(recvers, **kw)
+                served[recvers.index(end)] += 1
+            return served
+
+        # by default the first ready end always wins
+        assert share() == [600, 0, 0]
+        # each end gets about a third of the turns
+        assert all(150 < n < 250 for n in share(fair=True))
+        # or in proportion to their weights
+        served = share(weights=[4, 1, 1])
+        assert 300 < served[0] < 500
+        assert all(50 < n < 150 for n in served[1:])
+
     def test_pipe(self):
         h = vanilla.Hub()
 
@@ -279,6 +312,180 @@ class TestPipe(object):
         h.spawn(p1.send, 1)
         pytest.raises(E, p2.recv)
 
+    def test_filter(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        r = p.recver.filter(lambda x: x % 2)
+        h.spawn(p.send_many, range(6))
+        assert [r.recv(), r.recv(), r.recv()] == [1, 3, 5]
+
+    def test_flat_map(self):
+        h = vanilla.Hub()
+        p = h.pipe().flat_map(lambda x: x.split())
+        h.spawn(p.send, 'a b c')
+        assert p.recv_batch(3) == ['a']
+        assert [p.recv(), p.recv()] == ['b', 'c']
+
+    def test_fused(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        fused = recver \
+            .map(lambda x: x + 1) \
+            .filter(lambda x: x % 2) \
+            .flat_map(lambda x: [x, x]) \
+            .map(lambda x: x * 10)
+        # the chain is a single stage
+        assert fused is recver.downstream.other
+        assert len(fused.stages) == 4
+
+        h.spawn(sender.send_many, range(4))
+        assert [fused.recv() for _ in xrange(4)] == [10, 10, 30, 30]
+
+        # once the chain has taken an item, a new chain is started
+        strs = fused.map(str)
+        assert fused.downstream.other is strs
+        assert len(fused.stages) == 4
+        h.spawn(sender.send, 4)
+        assert strs.recv() == '50'
+
+    def test_fuse_new_end(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        m = recver.map(lambda x: x + 1)
+        m2 = m.map(lambda x: x * 10)
+        # the old end isn't changed, and is no longer sent to
+        assert m2 is not m
+        assert len(m.stages) == 1
+        assert len(m2.stages) == 2
+        assert recver.downstream.other is m2
+        h.spawn(sender.send, 1)
+        assert m2.recv() == 20
+        pytest.raises(vanilla.Abandoned, m.recv)
+
+    def test_fuse_in_flight(self):
+        h = vanilla.Hub()
+        q = h.queue(10)
+        q.send_many([0, 10, 20])
+        m = q.recver.map(lambda x: x + 1)
+        # the chain takes 0, and waits to pass on 1
+        h.sleep(1)
+        m = m.map(lambda x: x + 10).map(lambda x: x + 10)
+        assert [m.recv() for _ in xrange(3)] == [21, 31, 41]
+
+    def test_fuse_boundary(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        r1 = recver.map(lambda x: x + 1)
+        r2 = r1.map(lambda x: x * 2, fuse=False)
+        assert r2 is not r1
+        assert r1.downstream.other is r2
+        h.spawn(sender.send, 1)
+        assert r2.recv() == 4
+
+    def test_fused_close(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        r = recver.map(lambda x: x).map(lambda x: x)
+        sender.close()
+        pytest.raises(vanilla.Closed, r.recv)
+
+    def test_batch(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        b = p.recver.batch(3, 50)
+
+        # a full batch is passed on straight away
+        h.spawn(p.send_many, range(7))
+        assert b.recv(timeout=10) == [0, 1, 2]
+        assert b.recv(timeout=10) == [3, 4, 5]
+        # and a partial one once its first item has waited max_ms
+        pytest.raises(vanilla.Timeout, b.recv, timeout=10)
+        assert b.recv(timeout=100) == [6]
+
+        # items trickling in are collected until the deadline
+        @h.spawn
+        def _():
+            for i in xrange(4):
+                p.send(i)
+                h.sleep(10)
+        assert b.recv() == [0, 1, 2]
+        assert b.recv() == [3]
+        assert h.scheduled.count == 0
+
+    def test_batch_close(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        b = p.recver.batch(10, 1000)
+
+        @h.spawn
+        def _():
+            p.send_many([1, 2])
+            p.sender.close()
+
+        assert b.recv(timeout=100) == [1, 2]
+        pytest.raises(vanilla.Closed, b.recv)
+
+    def test_map_concurrent(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+
+        def slow(x):
+            # later items finish first
+            h.sleep(40 - x * 10)
+            return x * 2
+
+        r = p.recver.map_concurrent(slow, concurrency=4)
+        h.spawn(p.send_many, range(4))
+        start = h.now()
+        assert [r.recv() for _ in xrange(4)] == [0, 2, 4, 6]
+        # the calls overlapped
+        assert h.now() - start < 80
+
+        p = h.pipe()
+        r = p.recver.map_concurrent(slow, concurrency=4, ordered=False)
+        h.spawn(p.send_many, range(4))
+        assert [r.recv() for _ in xrange(4)] == [6, 4, 2, 0]
+
+    def test_map_concurrent_backpressure(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        gate = h.value()
+        running = []
+
+        def f(x):
+            running.append(x)
+            gate.get()
+            return x
+
+        r = p.recver.map_concurrent(f, concurrency=2)
+        h.spawn(p.send_many, range(5))
+        h.sleep(10)
+        # only two are taken while both slots are busy
+        assert running == [0, 1]
+        gate.set(True)
+        assert [r.recv() for _ in xrange(5)] == range(5)
+
+    def test_map_concurrent_close(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+
+        def f(x):
+            if x == 1:
+                raise Exception('oops')
+            return x
+
+        r = p.recver.map_concurrent(f, concurrency=2)
+
+        @h.spawn
+        def _():
+            p.send_many(range(3))
+            p.sender.close()
+
+        assert r.recv() == 0
+        pytest.raises(Exception, r.recv)
+        assert r.recv() == 2
+        pytest.raises(vanilla.Closed, r.recv)
+
     def test_chain(self):
         h = vanilla.Hub()
 
@@ -366,6 +573,112 @@ class TestPipe(object):
         assert pipe.sender() is None
 
 
+class TestBatch(object):
+    def test_send_many_then_recv_batch(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        check = h.pipe()
+
+        @h.spawn
+        def _():
+            p.send_many([1, 2, 3, 4, 5])
+            check.send('done')
+
+        assert p.recv_batch(3) == [1, 2, 3]
+        assert p.recv_batch(3) == [4, 5]
+        assert check.recv() == 'done'
+
+    def test_recv_batch_then_send_many(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        check = h.pipe()
+
+        @h.spawn
+        def _():
+            check.send(p.recv_batch(10))
+
+        h.sleep(1)
+        p.send_many([1, 2, 3])
+        assert check.recv() == [1, 2, 3]
+
+    def test_recv(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        h.spawn(p.send_many, [1, 2, 3])
+        assert [p.recv() for _ in xrange(3)] == [1, 2, 3]
+        pytest.raises(vanilla.Timeout, p.recv_batch, 10, timeout=0)
+
+    def test_send(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        h.spawn(p.send, 1)
+        assert p.recv_batch(10) == [1]
+
+    def test_send_many_timeout(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        pytest.raises(vanilla.Timeout, p.send_many, [1, 2], timeout=0)
+        assert p.sender.middle.pending is None
+
+    def test_exception(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        h.spawn(p.send_many, [1, Exception('oh no'), 2])
+        assert p.recv_batch(10) == [1]
+        pytest.raises(Exception, p.recv_batch, 10)
+        assert p.recv_batch(10) == [2]
+
+    def test_close(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        check = h.pipe()
+
+        @h.spawn
+        def _():
+            pytest.raises(vanilla.Closed, p.send_many, [1, 2, 3])
+            check.send('done')
+
+        assert p.recv() == 1
+        p.recver.close()
+        assert check.recv() == 'done'
+
+    def test_select(self):
+        h = vanilla.Hub()
+        p = h.pipe()
+        h.spawn(p.send_many, [1, 2])
+        h.sleep(1)
+        assert h.select([p.recver], timeout=0) == (p.recver, 1)
+        assert h.select([p.recver], timeout=0) == (p.recver, 2)
+
+    def test_router(self):
+        h = vanilla.Hub()
+        r = h.router()
+        h.spawn(r.send_many, [1, 2])
+        h.spawn(r.send_many, [3, 4])
+        got = []
+        while len(got) < 4:
+            got.extend(r.recv_batch(10))
+        assert sorted(got) == [1, 2, 3, 4]
+        assert got.index(1) < got.index(2)
+        assert got.index(3) < got.index(4)
+
+    def test_dealer(self):
+        h = vanilla.Hub()
+        d = h.dealer()
+        h.spawn(d.send_many, [1, 2, 3])
+        assert d.recv() == 1
+        assert d.recv_batch(10) == [2, 3]
+
+    def test_channel(self):
+        h = vanilla.Hub()
+        c = h.channel(10)
+        c.send_many([1, 2, 3], timeout=0)
+        got = []
+        while len(got) < 3:
+            got.extend(c.recv_batch(10))
+        assert got == [1, 2, 3]
+
+
 class TestQueue(object):
     def test_queue(self):
         h = vanilla.Hub()
@@ -399,6 +712,107 @@ class TestQueue(object):
         gc.collect()
         h.sleep(1)
 
+    def test_no_switch(self):
+        h = vanilla.Hub()
+        q = h.queue(3)
+        ready = len(h.ready)
+        q.send_many([1, 2, 3], timeout=0)
+        assert len(h.ready) == ready
+        assert q.recv_batch(2) == [1, 2]
+        assert q.recv(timeout=0) == 3
+        pytest.raises(vanilla.Timeout, q.recv, timeout=0)
+
+    def test_full(self):
+        h = vanilla.Hub()
+        q = h.queue(2)
+        check = h.pipe()
+
+        @h.spawn
+        def _():
+            for i in xrange(5):
+                q.send(i)
+            check.send('done')
+
+        h.sleep(1)
+        assert list(q.sender.middle.items) == [0, 1]
+        assert [q.recv() for i in xrange(5)] == [0, 1, 2, 3, 4]
+        assert check.recv() == 'done'
+
+    def test_recv_then_send(self):
+        h = vanilla.Hub()
+        q = h.queue(2)
+        check = h.pipe()
+        h.spawn(lambda: check.send(q.recv()))
+        h.sleep(1)
+        q.send(1)
+        assert check.recv() == 1
+
+    def test_select(self):
+        h = vanilla.Hub()
+        q = h.queue(1)
+        q.send(1)
+        h.spawn_later(10, q.recv)
+        assert h.select([q.sender], timeout=20) == (q.sender, None)
+        q.send(2, timeout=0)
+        assert h.select([q.recver], timeout=0) == (q.recver, 2)
+
+    def test_select_many(self):
+        h = vanilla.Hub()
+        q = h.queue(4)
+        p = h.pipe()
+
+        @h.spawn
+        def _():
+            # queues a wake for the select, which p then beats
+            q.send('A')
+            p.send('B')
+
+        assert h.select([q.recver, p.recver]) == (p.recver, 'B')
+        # the stale wake isn't delivered elsewhere, and 'A' is kept
+        h.spawn(p.send, 'C')
+        assert p.recv() == 'C'
+        assert q.recv(timeout=0) == 'A'
+
+    def test_select_many_sender(self):
+        h = vanilla.Hub()
+        q = h.queue(1)
+        q.send(1)
+        p = h.pipe()
+
+        @h.spawn
+        def _():
+            q.recv()
+            p.send('B')
+
+        assert h.select([q.sender, p.recver]) == (p.recver, 'B')
+        h.spawn(p.send, 'C')
+        assert p.recv() == 'C'
+        q.send(2, timeout=0)
+
+    def test_timeout_race(self):
+        h = vanilla.Hub()
+        q = h.queue(1)
+        # the send is due along with the recv's timeout, and runs first
+        h.spawn_later(10, q.send, 'A')
+        pytest.raises(vanilla.Timeout, q.recv, timeout=10)
+        assert q.recv(timeout=0) == 'A'
+
+    def test_close_recver(self):
+        h = vanilla.Hub()
+        q = h.queue(1)
+        check = h.pipe()
+
+        @h.spawn
+        def _():
+            q.send(1)
+            pytest.raises(vanilla.Closed, q.send, 2)
+            check.send('done')
+
+        h.sleep(1)
+        q.recver.close()
+        assert check.recv() == 'done'
+        pytest.raises(vanilla.Closed, q.recv)
+
 
 class TestPulse(object):
     def test_pulse(self):
@@ -455,6 +869,29 @@ class TestDealer(object):
         # assert that waiters is cleaned up after timeout
         assert not d.recver.current
 
+    def test_recv_timeout_fifo(self):
+        h = vanilla.Hub()
+        d = h.dealer()
+        check = h.queue(10)
+
+        def recv(name, timeout):
+            try:
+                check.send((name, d.recv(timeout=timeout)))
+            except vanilla.Timeout:
+                pass
+
+        # the middle recver times out, and the rest are still dealt to in
+        # the order they arrived
+        h.spawn(recv, 'r1', -1)
+        h.spawn(recv, 'r2', 10)
+        h.spawn(recv, 'r3', -1)
+        h.sleep(20)
+        assert len(d.recver.current) == 2
+        d.send(1)
+        d.send(2)
+        assert check.recv() == ('r1', 1)
+        assert check.recv() == ('r3', 2)
+
     def test_send_select(self):
         h = vanilla.Hub()
         d = h.dealer()
@@ -590,6 +1027,212 @@ class TestChannel(object):
         assert ch.recv() == 2
         assert ch.recv() == 3
 
+    def test_many(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        done = h.channel(100)
+
+        def produce(i):
+            for j in xrange(10):
+                ch.send((i, j))
+
+        def consume():
+            for _ in xrange(10):
+                done.send(ch.recv())
+
+        for i in xrange(10):
+            h.spawn(produce, i)
+            h.spawn(consume)
+
+        got = [done.recv() for i in xrange(100)]
+        assert sorted(got) == [(i, j) for i in xrange(10) for j in xrange(10)]
+
+    def test_buffer_then_senders(self):
+        h = vanilla.Hub()
+        ch = h.channel(2)
+        for i in xrange(4):
+            h.spawn(ch.send, i)
+        h.sleep(1)
+        assert len(ch.sender.middle.items) == 2
+        assert ch.recv_batch(3) == [0, 1, 2]
+        assert ch.recv_batch(3) == [3]
+        pytest.raises(vanilla.Timeout, ch.recv, timeout=0)
+
+    def test_recv_timeout(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        pytest.raises(vanilla.Timeout, ch.recv, timeout=10)
+        assert not ch.recver.middle.recver_current
+        h.spawn_later(10, ch.send, 1)
+        assert ch.recv(timeout=20) == 1
+
+    def test_select(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        h.spawn(ch.send, 1)
+        assert h.select([ch.recver], timeout=10) == (ch.recver, 1)
+
+        h.spawn(ch.recv)
+        assert h.select([ch.sender], timeout=10) == (ch.sender, None)
+        ch.send(2, timeout=0)
+        assert not ch.sender.middle.sender_current
+
+    def test_select_many(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        p = h.pipe()
+
+        @h.spawn
+        def _():
+            # queues a wake for the select, which p then beats
+            ch.send('A')
+            p.send('B')
+
+        assert h.select([ch.recver, p.recver]) == (p.recver, 'B')
+        # the stale wake isn't delivered elsewhere, and 'A' is kept
+        h.spawn(p.send, 'C')
+        assert p.recv() == 'C'
+        assert ch.recv(timeout=0) == 'A'
+
+    def test_select_many_next_recver(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        p = h.pipe()
+        check = h.queue(1)
+
+        @h.spawn
+        def _():
+            assert h.select([ch.recver, p.recver]) == (p.recver, 'B')
+
+        h.sleep(1)
+        h.spawn(lambda: check.send(ch.recv()))
+        h.sleep(1)
+        ch.send('A')
+        p.send('B')
+        # the select didn't take 'A', so it goes to the next recver
+        assert check.recv() == 'A'
+
+    def test_select_many_sender(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        p = h.pipe()
+        check = h.queue(1)
+
+        @h.spawn
+        def _():
+            assert h.select([ch.sender, p.recver]) == (p.recver, 'B')
+            h.spawn(p.send, 'C')
+            check.send(p.recv())
+
+        h.sleep(1)
+        # a real sender, behind the select
+        h.spawn(ch.send, 'S')
+        h.sleep(1)
+
+        # wakes the select, which p then beats
+        h.spawn(lambda: check.send(ch.recv()))
+        h.spawn(p.send, 'B')
+        # the select didn't take the slot, so it goes to the next sender
+        assert check.recv() == 'S'
+        assert check.recv() == 'C'
+
+    def test_select_sender_one_slot(self):
+        h = vanilla.Hub()
+        ch = h.channel(1)
+        ch.send(1)
+        check = h.queue(1)
+
+        @h.spawn
+        def _():
+            assert h.select([ch.sender]) == (ch.sender, None)
+            # the slot freed for the select is still there
+            ch.send('g', timeout=0)
+            check.send('sent')
+
+        h.sleep(1)
+        h.spawn(ch.send, 2)
+        h.sleep(1)
+
+        # frees one slot, which only the select is woken for
+        assert ch.recv() == 1
+        assert check.recv() == 'sent'
+        assert ch.recv() == 'g'
+        assert ch.recv() == 2
+
+    def test_timeout_race(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        # the send is due along with the recv's timeout, and runs first
+        h.spawn_later(10, ch.send, 'A')
+        pytest.raises(vanilla.Timeout, ch.recv, timeout=10)
+        assert ch.recv(timeout=0) == 'A'
+
+    def test_send_timeout_race(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        # the recv is due along with the send's timeout, and runs first. it
+        # takes the item, so the send is made
+        h.spawn_later(10, ch.recv)
+        ch.send('A', timeout=10)
+        assert not ch.sender.middle.sender_current
+
+    def test_close(self):
+        h = vanilla.Hub()
+        ch = h.channel()
+        check = h.channel(10)
+
+        def recv():
+            try:
+                ch.recv()
+            except vanilla.Closed:
+                check.send('closed')
+
+        h.spawn(recv)
+        h.spawn(recv)
+        h.sleep(1)
+        ch.close()
+        assert check.recv() == 'closed'
+        assert check.recv() == 'closed'
+
+    def test_close_sender_drains(self):
+        h = vanilla.Hub()
+        ch = h.channel(2)
+        ch.send(1)
+        ch.send(2)
+        ch.sender.close()
+        assert ch.recv() == 1
+        assert ch.recv() == 2
+        pytest.raises(vanilla.Closed, ch.recv)
+
+
+class TestWaiters(object):
+    def test_waiters(self):
+        w = vanilla.message.Waiters()
+        assert not w
+        assert w.peak is None
+        for i in xrange(5):
+            w.append(i, 'item%s' % i)
+        w.remove(0)
+        w.remove(3)
+        w.remove(7)
+        assert len(w) == 3
+        assert 3 not in w
+        assert list(w) == [1, 2, 4]
+        assert w.peak == 1
+        assert w.popleft() == (1, 'item1')
+        assert w.popleft() == (2, 'item2')
+        assert w.popleft() == (4, 'item4')
+        assert not w
+
+    def test_compact(self):
+        w = vanilla.message.Waiters()
+        w.append('head')
+        for i in xrange(1000):
+            w.append(i)
+            w.remove(i)
+        assert len(w.queue) < 20
+        assert w.popleft() == ('head', None)
+
 
 class TestBroadcast(object):
     def test_broadcast(self):
@@ -648,6 +1291,64 @@ class TestBroadcast(object):
         assert check.recv() == ('s1', True)
         assert check.recv() == ('s2', True)
 
+    def test_block(self):
+        h = vanilla.Hub()
+        b = h.broadcast(size=2)
+        s = b.subscribe()
+        b.send(1)
+        b.send(2)
+        assert s.lag == 2
+        # the third send blocks until the subscriber makes room
+        h.spawn(b.send, 3)
+        h.sleep(1)
+        assert s.lag == 2
+        assert s.recv() == 1
+        h.sleep(1)
+        assert list(s.recv_batch(10)) == [2, 3]
+        assert s.dropped == 0
+
+    def test_drop_oldest(self):
+        h = vanilla.Hub()
+        b = h.broadcast(size=2, policy=vanilla.message.DROP_OLDEST)
+        s = b.subscribe()
+        for i in xrange(5):
+            b.send(i)
+        assert s.lag == 2
+        assert s.dropped == 3
+        assert list(s.recv_batch(10)) == [3, 4]
+
+    def test_drop_newest(self):
+        h = vanilla.Hub()
+        b = h.broadcast(size=2, policy=vanilla.message.DROP_NEWEST)
+        s = b.subscribe()
+        for i in xrange(5):
+            b.send(i)
+        assert s.dropped == 3
+        assert list(s.recv_batch(10)) == [0, 1]
+
+    def test_disconnect(self):
+        h = vanilla.Hub()
+        b = h.broadcast(size=2)
+        slow = b.subscribe(policy=vanilla.message.DISCONNECT)
+        fast = b.subscribe(size=10)
+        for i in xrange(5):
+            b.send(i)
+        assert len(b.subscribers) == 1
+        assert slow.dropped == 1
+        # the laggard still gets what was buffered before it was closed
+        assert list(slow) == [0, 1]
+        assert list(fast.recv_batch(10)) == [0, 1, 2, 3, 4]
+
+    def test_abandoned(self):
+        h = vanilla.Hub()
+        b = h.broadcast()
+        b.subscribe()
+        s = b.subscribe()
+        gc.collect()
+        b.send(1)
+        assert len(b.subscribers) == 1
+        assert s.recv() == 1
+
 
 class TestState(object):
     def test_state(self):
@@ -679,6 +1380,252 @@ class TestState(object):
         assert p.recv() == 'foofoo.'
         # TODO: should clear be able to be passed through map?
 
+    def test_select(self):
+        h = vanilla.Hub()
+        s = h.state()
+        pytest.raises(vanilla.Timeout, h.select, [s.recver], timeout=0)
+        h.spawn_later(10, s.send, 'Toby')
+        assert h.select([s.recver], timeout=20) == (s.recver, 'Toby')
+        assert h.select([s.recver], timeout=0) == (s.recver, 'Toby')
+
+    def test_select_many(self):
+        h = vanilla.Hub()
+        s = h.state()
+        p = h.pipe()
+
+        @h.spawn
+        def _():
+            # queues a wake for the select, which p then beats
+            s.send('A')
+            p.send('B')
+
+        assert h.select([s.recver, p.recver]) == (p.recver, 'B')
+        # the stale wake isn't delivered elsewhere
+        h.spawn(p.send, 'C')
+        assert p.recv() == 'C'
+        assert h.select([s.recver], timeout=0) == (s.recver, 'A')
+        assert not s.recver.middle.value.woken
+
+    def test_select_clear(self):
+        h = vanilla.Hub()
+        s = h.state()
+        check = h.queue(1)
+        h.spawn(lambda: check.send(h.select([s.recver])))
+        h.sleep(1)
+        # the select carries on waiting for a value
+        s.clear()
+        h.sleep(1)
+        s.send('P')
+        assert check.recv() == (s.recver, 'P')
+
+    def test_close(self):
+        h = vanilla.Hub()
+        s = h.state()
+        check = h.pipe()
+
+        @h.spawn
+        def _():
+            pytest.raises(vanilla.Closed, s.recv)
+            check.send('done')
+
+        h.sleep(1)
+        s.close()
+        assert check.recv() == 'done'
+
+
+class TestValue(object):
+    def test_value(self):
+        h = vanilla.Hub()
+        v = h.value()
+        assert not v.ready
+        pytest.raises(vanilla.Timeout, v.get, timeout=10)
+
+        h.spawn_later(10, v.set, 'Toby')
+        assert v.get() == 'Toby'
+        assert v.version == 1
+
+        ready = len(h.ready)
+        assert v.get(timeout=0) == 'Toby'
+        assert len(h.ready) == ready
+
+        v.clear()
+        assert not v.ready
+        assert v.version == 2
+        pytest.raises(vanilla.Timeout, v.get, timeout=10)
+
+    def test_wait_changed(self):
+        h = vanilla.Hub()
+        v = h.value('a')
+        check = h.channel(10)
+
+        def watch(version):
+            check.send(v.wait_changed(version))
+
+        for _ in xrange(5):
+            h.spawn(watch, v.version)
+        h.sleep(1)
+        assert len(v.waiters) == 5
+
+        v.set('b')
+        assert [check.recv() for i in xrange(5)] == [('b', 1)] * 5
+        assert not v.waiters
+
+        # already changed, so this returns straight away
+        assert v.wait_changed(0) == ('b', 1)
+        pytest.raises(vanilla.Timeout, v.wait_changed, 1, timeout=10)
+        assert not v.waiters
+
+    def test_wait_changed_clear(self):
+        h = vanilla.Hub()
+        v = h.value('a')
+        h.spawn_later(10, v.clear)
+        assert v.wait_changed(0) == (vanilla.message.NoState, 1)
+
+    def test_timeout_race(self):
+        h = vanilla.Hub()
+        v = h.value()
+        # the set is due along with the wait's timeout, and runs first
+        h.spawn_later(10, v.set, 'a')
+        pytest.raises(vanilla.Timeout, v.wait_changed, 0, timeout=10)
+        assert not v.waiters
+        assert not v.woken
+        # the wake was cancelled, and isn't delivered to the next pause
+        h.spawn_later(10, v.set, 'b')
+        assert v.wait_changed(1) == ('b', 2)
+
+
+class TestSelector(object):
+    def test_select(self):
+        h = vanilla.Hub()
+
+        s1, r1 = h.pipe()
+        s2, r2 = h.pipe()
+        check = h.queue(2)
+        selector = h.selector([s1, r2])
+
+        @h.spawn
+        def _():
+            check.send(r1.recv())
+
+        @h.spawn
+        def _():
+            s2.send(10)
+            check.send('done')
+
+        ch, item = selector.select()
+        assert ch == s1
+        s1.send(20)
+
+        ch, item = selector.select()
+        assert ch == r2
+        assert item == 10
+
+        assert sorted([check.recv(), check.recv()]) == [20, 'done']
+
+    def test_timeout(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        selector = h.selector([recver])
+        pytest.raises(vanilla.Timeout, selector.select, timeout=10)
+        h.spawn_later(10, sender.send, 1)
+        pytest.raises(vanilla.Timeout, selector.select, timeout=0)
+        assert selector.select(timeout=20) == (recver, 1)
+        assert h.scheduled.count == 0
+
+    def test_timeout_race(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        selector = h.selector([recver])
+        # the send is due along with the select's timeout, and runs first
+        h.spawn_later(10, sender.send, 'A')
+        pytest.raises(vanilla.Timeout, selector.select, timeout=10)
+        # what fired is kept, and the wake isn't delivered elsewhere
+        assert selector.select(timeout=0) == (recver, 'A')
+        p = h.pipe()
+        h.spawn_later(10, p.send, 'B')
+        assert p.recv() == 'B'
+
+    def test_many(self):
+        h = vanilla.Hub()
+        pipes = [h.pipe() for _ in xrange(100)]
+        selector = h.selector(recver for _, recver in pipes)
+        assert len(selector) == 100
+
+        for i, (sender, _) in enumerate(pipes):
+            h.spawn(sender.send_many, [i, i])
+
+        got = [selector.select()[1] for _ in xrange(200)]
+        assert sorted(got) == sorted(range(100) * 2)
+        pytest.raises(vanilla.Timeout, selector.select, timeout=0)
+
+    def test_ready_when_added(self):
+        h = vanilla.Hub()
+        q = h.queue(2)
+        q.send(1)
+        q.send(2)
+        selector = h.selector([q.recver])
+        assert selector.select() == (q.recver, 1)
+        assert selector.select() == (q.recver, 2)
+        pytest.raises(vanilla.Timeout, selector.select, timeout=0)
+
+    def test_select_all(self):
+        h = vanilla.Hub()
+        c = h.channel()
+        s = h.state()
+        q = h.queue(1)
+        selector = h.selector([c.recver, s.recver, q.recver])
+
+        h.spawn(c.send, 'c')
+        h.spawn(s.send, 's')
+        h.sleep(1)
+        got = selector.select_all()
+        assert sorted(item for _, item in got) == ['c', 's']
+
+        h.spawn_later(10, q.send, 'q')
+        assert selector.select_all() == [(s.recver, 's')]
+
+    def test_close(self):
+        h = vanilla.Hub()
+        s1, r1 = h.pipe()
+        s2, r2 = h.pipe()
+        selector = h.selector([r1, r2])
+
+        h.spawn(s1.close)
+        end, item = selector.select()
+        assert end == r1
+        assert isinstance(item, vanilla.Closed)
+        assert r1 not in selector
+
+        h.spawn(s2.send, Exception('oops'))
+        end, item = selector.select()
+        assert end == r2
+        assert item.message == 'oops'
+        assert r2 in selector
+
+    def test_fair(self):
+        h = vanilla.Hub()
+        queues = [h.queue(1000) for _ in xrange(3)]
+        for q in queues:
+            q.send_many(xrange(1000))
+        recvers = [q.recver for q in queues]
+        selector = h.selector(recvers)
+
+        served = [0] * len(recvers)
+        for _ in xrange(900):
+            end, _ = selector.select()
+            served[recvers.index(end)] += 1
+        assert served == [300, 300, 300]
+
+    def test_remove(self):
+        h = vanilla.Hub()
+        sender, recver = h.pipe()
+        selector = h.selector([recver])
+        selector.remove(recver)
+        assert len(selector) == 0
+        h.spawn(sender.send, 1)
+        assert recver.recv() == 1
+        pytest.raises(vanilla.Timeout, recver.recv, timeout=0)
+
 
 class TestSerialize(object):
     def test_serialize(self):
@@ -1,5 +1,8 @@
 import os
 
+import pytest
+
+import vanilla
 import vanilla.poll
 
 
@@ -57,3 +60,89 @@ class TestPoll(object):
         got = poll.poll()
         assert got == [(w, vanilla.poll.POLLERR)]
         assert poll.poll(timeout=0) == []
+
+
+def uring():
+    try:
+        return vanilla.poll.Uring()
+    except OSError, e:
+        pytest.skip('io_uring unavailable: %s' % e)
+
+
+class TestUring(object):
+    def test_poll(self):
+        poll = uring()
+
+        r, w = os.pipe()
+
+        poll.register(r, vanilla.poll.POLLIN)
+        assert poll.poll(timeout=0) == []
+
+        os.write(w, '1')
+        assert poll.poll() == [(r, vanilla.poll.POLLIN)]
+        # test event is cleared
+        assert poll.poll(timeout=0) == []
+
+        # test event is reset on new write without read
+        os.write(w, '2')
+        assert poll.poll() == [(r, vanilla.poll.POLLIN)]
+        assert poll.poll(timeout=0.01) == []
+
+        assert os.read(r, 4096) == '12'
+
+    def test_write_close(self):
+        poll = uring()
+        r, w = os.pipe()
+
+        poll.register(r, vanilla.poll.POLLIN)
+        poll.register(w, vanilla.poll.POLLOUT)
+        assert poll.poll() == [(w, vanilla.poll.POLLOUT)]
+        assert poll.poll(timeout=0) == []
+
+        # the pending poll holds a reference to the file, so it has to be
+        # unregistered for the close to take effect
+        poll.unregister(w, vanilla.poll.POLLOUT)
+        os.close(w)
+        assert poll.poll() == [(r, vanilla.poll.POLLERR)]
+        assert poll.poll(timeout=0) == []
+
+    def test_modify(self):
+        poll = uring()
+        r, w = os.pipe()
+
+        poll.register(w, vanilla.poll.POLLIN)
+        assert poll.poll(timeout=0.01) == []
+        poll.modify(w, vanilla.poll.POLLIN, vanilla.poll.POLLOUT)
+        assert poll.poll() == [(w, vanilla.poll.POLLOUT)]
+
+    def test_probe(self):
+        poll = uring()
+        # the probe's poll is taken down, and its completions are ignored
+        assert poll.probe()
+        assert poll.poll(timeout=0) == []
+        assert poll.poll(timeout=0.01) == []
+
+    def test_probe_fails(self, monkeypatch):
+        uring().close()
+        monkeypatch.setattr(vanilla.poll.Uring, 'probe', lambda self: False)
+        pytest.raises(OSError, vanilla.poll.Uring)
+        assert isinstance(vanilla.poll.uring(), vanilla.poll.Poll)
+
+    def test_hub(self):
+        uring().close()
+        h = vanilla.Hub(poll=vanilla.poll.Uring)
+        server = h.tcp.listen()
+
+        @h.spawn
+        def _():
+            conn = server.recv()
+            for data in conn.recver:
+                conn.send('Echo: ' + data)
+
+        client = h.tcp.connect(server.port)
+        for i in xrange(10):
+            client.send(str(i))
+            assert client.recv() == 'Echo: %s' % i
+
+        h.stop()
+        assert not h.registered
@@ -1,9 +1,11 @@
+import subprocess
 import signal
 import os
 
 import pytest
 
 import vanilla
+import vanilla.signal
 
 
 class TestSignal(object):
@@ -34,3 +36,92 @@ class TestSignal(object):
         h = vanilla.Hub()
         h.spawn_later(10, os.kill, os.getpid(), signal.SIGINT)
         h.stop_on_term()
+
+    @pytest.mark.skipif(
+        not vanilla.signal.signalfd, reason='signalfd unavailable')
+    def test_siginfo(self):
+        h = vanilla.Hub()
+        s = h.signal.subscribe(signal.SIGUSR1, signal.SIGCHLD)
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+        sig = s.recv()
+        assert sig == signal.SIGUSR1
+        assert sig.pid == os.getpid()
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(3)
+        sig = s.recv()
+        assert sig == signal.SIGCHLD
+        assert sig.pid == pid
+        assert sig.status == 3
+        os.waitpid(pid, 0)
+
+        s.close()
+        assert not h.registered
+        assert signal.SIGUSR1 not in vanilla.signal.blocked
+
+    def test_fallback(self, monkeypatch):
+        monkeypatch.setattr(vanilla.signal, 'signalfd', None)
+        h = vanilla.Hub()
+        s = h.signal.subscribe(signal.SIGUSR1)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        sig = s.recv()
+        assert sig == signal.SIGUSR1
+        assert sig.pid is None
+        s.close()
+        assert not h.registered
+
+    @pytest.mark.skipif(
+        not vanilla.signal.signalfd, reason='signalfd unavailable')
+    def test_two_hubs(self):
+        h1 = vanilla.Hub()
+        h2 = vanilla.Hub()
+        s1 = h1.signal.subscribe(signal.SIGUSR2)
+        s2 = h2.signal.subscribe(signal.SIGUSR2)
+        assert vanilla.signal.blocked[signal.SIGUSR2] == 2
+
+        # the first Hub to finish mustn't unblock the signal on the other
+        s1.close()
+        assert vanilla.signal.blocked[signal.SIGUSR2] == 1
+        os.kill(os.getpid(), signal.SIGUSR2)
+        assert s2.recv() == signal.SIGUSR2
+
+        s2.close()
+        assert signal.SIGUSR2 not in vanilla.signal.blocked
+
+    @pytest.mark.skipif(
+        not vanilla.signal.signalfd, reason='signalfd unavailable')
+    def test_drain_on_unblock(self):
+        h = vanilla.Hub()
+        s = h.signal.subscribe(signal.SIGUSR2)
+        # left pending, unread, as the last subscriber goes. unblocking it
+        # would otherwise kill us with SIGUSR2's default action
+        os.kill(os.getpid(), signal.SIGUSR2)
+        s.close()
+        assert signal.SIGUSR2 not in vanilla.signal.blocked
+
+    @pytest.mark.skipif(
+        not vanilla.signal.signalfd, reason='signalfd unavailable')
+    def test_child_unblocked(self):
+        h = vanilla.Hub()
+        count = vanilla.signal.blocked.get(signal.SIGTERM, 0)
+        s = h.signal.subscribe(signal.SIGTERM)
+        assert vanilla.signal.blocked[signal.SIGTERM] == count + 1
+
+        # the signal mask is inherited across fork and exec
+        child = subprocess.Popen(['sleep', '10'])
+        child.terminate()
+        assert child.wait() == -signal.SIGTERM
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(len(vanilla.signal.blocked))
+        assert os.waitpid(pid, 0)[1] >> 8 == 0
+
+        # the parent is unaffected
+        os.kill(os.getpid(), signal.SIGTERM)
+        assert s.recv() == signal.SIGTERM
+
+        s.close()
+        assert vanilla.signal.blocked.get(signal.SIGTERM, 0) == count
@@ -1,4 +1,5 @@
-__import__('pkg_resources').declare_namespace(__name__) 
+# a pkgutil style namespace package: pkg_resources is slow to import
+__path__ = __import__('pkgutil').extend_path(__path__, __name__)
 
 from vanilla.core import Hub
 
@@ -3,12 +3,16 @@
 from __future__ import absolute_import
 
 import collections
-import functools
+import itertools
 import importlib
 import logging
+import pkgutil
 import signal
 import heapq
+import math
 import time
+import sys
+import os
 
 
 from greenlet import getcurrent
@@ -32,17 +36,82 @@ class lazy(object):
         return value
 
 
+# time.monotonic is only available from Python 3.3. Otherwise call
+# clock_gettime directly, and failing that, fall back to the wall clock. The
+# clock is resolved when it's first needed, which is usually the first Hub,
+# so that importing vanilla doesn't load ctypes.
+clock = None
+
+
+def load_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+
+    try:
+        import ctypes
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_MONOTONIC = 6 if sys.platform == 'darwin' else 1
+        try:
+            clock_gettime = ctypes.CDLL('libc.so.6').clock_gettime
+        except (OSError, AttributeError):
+            clock_gettime = ctypes.CDLL(
+                'librt.so.1' if sys.platform.startswith('linux')
+                else None).clock_gettime
+        clock_gettime.restype = ctypes.c_int
+        # argtypes is left unset: ctypes' default conversions of an int and a
+        # byref are already right, and checking them doubles the cost of a
+        # call
+
+        # the clock is read on every turn of the loop, so a single timespec
+        # is reused, rather than allocating one for each reading
+        t = timespec()
+        ref = ctypes.byref(t)
+
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC, ref):
+                raise OSError('clock_gettime failed')
+            return t.tv_sec + t.tv_nsec / 1e9
+
+        monotonic()
+        return monotonic
+
+    except Exception:
+        log.warn('unable to use clock_gettime: falling back to time.time')
+        return time.time
+
+
+def get_clock():
+    """
+    Returns the monotonic clock, a callable which returns seconds as a float.
+    """
+    global clock
+    if clock is None:
+        clock = load_clock()
+    return clock
+
+
+def monotonic():
+    return get_clock()()
+
+
 class Scheduler(object):
-    Item = collections.namedtuple('Item', ['due', 'action', 'args'])
+    # seq breaks ties between timers due at the same time, so they fire in
+    # the order they were added
+    Item = collections.namedtuple('Item', ['due', 'seq', 'action', 'args'])
 
-    def __init__(self):
+    def __init__(self, clock=None):
+        self.clock = clock or get_clock()
         self.count = 0
         self.queue = []
         self.removed = {}
+        self.seq = itertools.count()
 
     def add(self, delay, action, *args):
-        due = time.time() + (delay / 1000.0)
-        item = self.Item(due, action, args)
+        due = self.clock() + (delay / 1000.0)
+        item = self.Item(due, next(self.seq), action, args)
         heapq.heappush(self.queue, item)
         self.count += 1
         return item
@@ -63,7 +132,7 @@ class Scheduler(object):
 
     def timeout(self):
         self.prune()
-        return self.queue[0].due - time.time()
+        return self.queue[0].due - self.clock()
 
     def pop(self):
         self.prune()
@@ -72,6 +141,586 @@ class Scheduler(object):
         return item.action, item.args
 
 
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel with the same interface as `Scheduler`.
+
+    Timers are hashed by their due tick into wheels of 2 ** *bits* buckets,
+    each wheel covering 2 ** *bits* times the span of the one inside it, so
+    adding and removing a timer is O(1) no matter how many are pending. As
+    time advances, buckets on the outer wheels are cascaded down to the inner
+    ones and a due bucket expires all of its timers in one go. Outer wheels
+    are added as needed. *resolution* is the length of a tick in milliseconds.
+    *clock* returns the current time in seconds.
+
+    It isn't a general speedup over `Scheduler`. In pure Python each add, and
+    firing timers that are actually due, costs more than a heap push and pop,
+    so with few cancellations the wheel is slower overall. It only pulls
+    ahead when half or more of the timers are cancelled before they fire,
+    such as timeouts that are usually satisfied, and there are tens of
+    thousands or more of them pending. See benchmarks/scheduler.py.
+    """
+    class Item(object):
+        __slots__ = [
+            'due', 'seq', 'action', 'args', 'tick', 'level', 'bucket']
+
+        def __init__(self, due, seq, action, args, tick):
+            self.due = due
+            self.seq = seq
+            self.action = action
+            self.args = args
+            self.tick = tick
+
+    def __init__(self, clock=None, resolution=1, bits=8):
+        self.clock = clock or get_clock()
+        self.resolution = resolution / 1000.0
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+
+        # each wheel maps a bucket index to a dict of the timers in it. only
+        # non empty buckets are kept
+        self.wheels = [{}]
+        self.sizes = [0]
+        self.tick = int(self.clock() / self.resolution)
+
+        # timers whose tick has been reached, as a heap of (due, seq, item).
+        # seq breaks ties so timers due together fire in the order added
+        self.expired = []
+        self.seq = itertools.count()
+
+        self.count = 0
+        self.next = None
+
+    def add(self, delay, action, *args):
+        due = self.clock() + (delay / 1000.0)
+        item = self.Item(
+            due, next(self.seq), action, args,
+            int(math.ceil(due / self.resolution)))
+        self.place(item)
+        self.count += 1
+        if self.next is not None and due < self.next.due:
+            self.next = item
+        return item
+
+    def place(self, item):
+        delta = item.tick - self.tick
+        if delta <= 0:
+            item.bucket = self.expired
+            heapq.heappush(self.expired, (item.due, item.seq, item))
+            return
+
+        level = 0
+        while delta >> (self.bits * (level + 1)):
+            level += 1
+        while level >= len(self.wheels):
+            self.wheels.append({})
+            self.sizes.append(0)
+
+        index = (item.tick >> (self.bits * level)) & self.mask
+        wheel = self.wheels[level]
+        bucket = wheel.get(index)
+        if bucket is None:
+            bucket = wheel[index] = {}
+        bucket[item] = True
+        item.level = level
+        item.bucket = bucket
+        self.sizes[level] += 1
+
+    def __len__(self):
+        return self.count
+
+    def remove(self, item):
+        bucket = item.bucket
+        if bucket is None:
+            # already fired or removed
+            return
+        item.bucket = None
+        # items on the expired heap are dropped lazily as they reach the top
+        if bucket is not self.expired:
+            del bucket[item]
+            self.sizes[item.level] -= 1
+            if not bucket:
+                index = (item.tick >> (self.bits * item.level)) & self.mask
+                del self.wheels[item.level][index]
+        self.count -= 1
+        if self.next is item:
+            self.next = None
+
+    def advance(self, tick):
+        """
+        Moves every timer due at or before *tick* onto the expired heap.
+        """
+        bits = self.bits
+        while self.tick < tick:
+            # skip ticks where nothing can happen: when the inner wheels are
+            # empty, jump to the next boundary where an outer wheel cascades
+            level = 0
+            while level < len(self.sizes) and not self.sizes[level]:
+                level += 1
+            if level == len(self.sizes):
+                self.tick = tick
+                break
+            # the next tick where the lowest occupied wheel cascades
+            shift = bits * max(level, 1)
+            boundary = ((self.tick >> shift) + 1) << shift
+            if level:
+                t = min(tick, boundary)
+            else:
+                # step to the next occupied inner bucket
+                t = self.tick + 1
+                wheel = self.wheels[0]
+                while t < boundary and t < tick and (
+                        t & self.mask) not in wheel:
+                    t += 1
+            self.tick = t
+            if t == tick and t != boundary:
+                self.cascade(0, t & self.mask)
+                break
+
+            level = 1
+            while level < len(self.wheels) and not (
+                    t & ((1 << (bits * level)) - 1)):
+                self.cascade(level, (t >> (bits * level)) & self.mask)
+                level += 1
+            self.cascade(0, t & self.mask)
+
+    def cascade(self, level, index):
+        bucket = self.wheels[level].pop(index, None)
+        if bucket:
+            self.sizes[level] -= len(bucket)
+            for item in bucket:
+                self.place(item)
+
+    def earliest(self):
+        if self.next is None:
+            self.next = self.find()
+        return self.next
+
+    def find(self):
+        expired = self.expired
+        while expired and expired[0][2].bucket is not expired:
+            heapq.heappop(expired)
+        if expired:
+            return expired[0][2]
+
+        # the first non empty bucket after the current position holds the
+        # earliest timer for each wheel. outer buckets can be skipped
+        # entirely if they start after the best candidate found so far
+        found = None
+        for level, wheel in enumerate(self.wheels):
+            if not wheel:
+                continue
+            shift = self.bits * level
+            position = (self.tick >> shift) + 1
+            while (position & self.mask) not in wheel:
+                position += 1
+            if found is not None and found.tick < (position << shift):
+                continue
+            item = min(
+                wheel[position & self.mask],
+                key=lambda item: (item.due, item.seq))
+            if found is None or (item.due, item.seq) < (found.due, found.seq):
+                found = item
+        return found
+
+    def timeout(self):
+        return self.earliest().due - self.clock()
+
+    def pop(self):
+        self.advance(self.earliest().tick)
+        while True:
+            _, _, item = heapq.heappop(self.expired)
+            if item.bucket is self.expired:
+                break
+        item.bucket = None
+        self.count -= 1
+        self.next = None
+        return item.action, item.args
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class Ready(object):
+    """
+    The queue of tasks ready to run on a Hub, split into priority levels.
+
+    The highest priority level with waiting tasks is always serviced first,
+    but each level may only run *weights[level]* tasks per round. Once every
+    level with waiting tasks has used up its share, a new round begins. This
+    means high priority work runs first, while lower priority work still gets
+    a turn and can't be starved.
+    """
+    def __init__(self, weights=(16, 4, 1)):
+        self.weights = weights
+        self.credits = list(weights)
+        self.queues = [collections.deque() for _ in weights]
+        # the number of tasks run from each level
+        self.served = [0] * len(weights)
+        # the level of the last task popped
+        self.level = PRIORITY_NORMAL
+
+    # note there's deliberately no separate count of tasks: tasks may be
+    # appended from a preemptive signal handler, so appending needs to be
+    # atomic
+
+    def append(self, task, priority=PRIORITY_NORMAL):
+        self.queues[priority].append(task)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def __nonzero__(self):
+        return any(self.queues)
+
+    def depths(self):
+        return [len(queue) for queue in self.queues]
+
+    def popleft(self):
+        for _ in xrange(2):
+            for level, queue in enumerate(self.queues):
+                if queue and self.credits[level]:
+                    self.credits[level] -= 1
+                    self.served[level] += 1
+                    self.level = level
+                    return queue.popleft()
+            self.credits = list(self.weights)
+        raise IndexError('pop from an empty queue')
+
+
+class Descriptor(object):
+    """
+    A file descriptor registered with a Hub's poller. *masks* are the events
+    the poller is watching for, *waiting* maps a mask to the green thread
+    blocked in `Hub.wait_readable` or `Hub.wait_writable`, and *pipes* maps a
+    mask to the `Sender`_ handed out by `Hub.register`.
+
+    The poller is edge triggered, so an event is only reported once. If
+    nothing is waiting for it when it arrives, its mask is latched in
+    *latched* until the next wait consumes it.
+    """
+    __slots__ = ['fd', 'masks', 'waiting', 'latched', 'pipes', 'closers']
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.masks = []
+        self.waiting = {}
+        self.latched = set()
+        self.pipes = {}
+        self.closers = []
+
+    def onclose(self, f, *a):
+        """
+        Arranges for *f(\*a)* to be called once the descriptor is
+        unregistered, including when its Hub is stopped.
+        """
+        self.closers.append((f, a))
+
+
+class Descriptors(object):
+    """
+    Maps file descriptors to their `Descriptor`. Descriptors below *size* are
+    kept in a list indexed by fd, so finding one as its events arrive is a
+    single index; larger ones overflow to a dict.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.table = []
+        self.overflow = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, fd):
+        return self.get(fd) is not None
+
+    def get(self, fd):
+        if fd < len(self.table):
+            return self.table[fd]
+        return self.overflow.get(fd)
+
+    def add(self, descriptor):
+        fd = descriptor.fd
+        if fd < self.size:
+            if fd >= len(self.table):
+                grow = min(max(fd + 1, len(self.table) * 2), self.size)
+                self.table.extend([None] * (grow - len(self.table)))
+            self.table[fd] = descriptor
+        else:
+            self.overflow[fd] = descriptor
+        self.count += 1
+
+    def pop(self, fd):
+        if fd < len(self.table):
+            descriptor = self.table[fd]
+            self.table[fd] = None
+        else:
+            descriptor = self.overflow.pop(fd, None)
+        if descriptor is not None:
+            self.count -= 1
+        return descriptor
+
+    def values(self):
+        return [
+            descriptor for descriptor in self.table
+            if descriptor is not None] + self.overflow.values()
+
+
+class Wake(object):
+    """
+    A handle to a green thread queued to be resumed with `Hub.wake`. The wake
+    can be taken back with `cancel` until it's run.
+    """
+    __slots__ = ['target', 'args']
+
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+
+    @property
+    def pending(self):
+        return self.target is not None
+
+    def run(self):
+        target = self.target
+        if target is not None:
+            self.target = None
+            target.switch(*self.args)
+
+    def cancel(self):
+        """
+        Cancels the wake. Returns True if it was still pending, False if its
+        green thread has already been resumed with it, or it was already
+        cancelled.
+        """
+        if self.target is None:
+            return False
+        self.target = None
+        return True
+
+
+class Timer(object):
+    """
+    A handle to a callable scheduled with `Hub.spawn_later`. The callable is
+    run once, on a pooled worker green thread, unless the Timer is cancelled
+    first.
+    """
+    def __init__(self, hub, ms, f, a, slack=None):
+        self.hub = hub
+        self.f = f
+        self.a = a
+        self.slack = slack
+        self.item = hub.scheduled.add(hub.coalesce(ms, slack), self.fire)
+
+    @property
+    def pending(self):
+        return self.item is not None
+
+    def fire(self):
+        self.item = None
+        self.f(*self.a)
+
+    def cancel(self):
+        """
+        Cancels the Timer. Returns True if it was still pending, False if it
+        had already fired or been cancelled.
+        """
+        if self.item is None:
+            return False
+        self.hub.scheduled.remove(self.item)
+        self.item = None
+        return True
+
+    def reschedule(self, ms):
+        """
+        Moves the Timer to fire *ms* milliseconds from now. A Timer which has
+        already fired or been cancelled is armed again.
+        """
+        self.cancel()
+        self.item = self.hub.scheduled.add(
+            self.hub.coalesce(ms, self.slack), self.fire)
+
+
+class Periodic(Timer):
+    """
+    A handle to a callable run repeatedly with `Hub.every`.
+
+    With *fixed_rate* the n'th run is due *n* periods after the first, no
+    matter how long the callable takes or how late the Hub gets to it, so the
+    cadence doesn't drift. If a run is late enough that whole periods have
+    gone by, those runs are skipped rather than bunched up, and counted in
+    *missed*. Without *fixed_rate* each run is due a period after the
+    previous one returned.
+    """
+    def __init__(self, hub, ms, f, a, fixed_rate=True, slack=None):
+        self.hub = hub
+        self.f = f
+        self.a = a
+        self.slack = slack
+        self.period = ms / 1000.0
+        self.fixed_rate = fixed_rate
+        self.active = True
+        # the number of runs skipped because they fell too far behind
+        self.missed = 0
+        self.item = None
+        self.reschedule(ms)
+
+    def reschedule(self, ms):
+        """
+        Moves the next run to *ms* milliseconds from now. Later runs follow
+        on every period from there.
+        """
+        self.cancel()
+        self.active = True
+        # deadlines are *origin* + *ticks* periods
+        self.origin = self.hub.now() + ms / 1000.0
+        self.ticks = 0
+        self.item = self.hub.scheduled.add(
+            self.hub.coalesce(ms, self.slack), self.fire)
+
+    def cancel(self):
+        """
+        Stops any further runs. Returns True if a run was pending.
+        """
+        self.active = False
+        return super(Periodic, self).cancel()
+
+    def fire(self):
+        self.item = None
+        try:
+            self.f(*self.a)
+        finally:
+            # the callable may have cancelled or rescheduled us
+            if self.active and self.item is None:
+                self.schedule()
+
+    def schedule(self):
+        # the Hub's time is stale if the callable ran for a while without
+        # yielding, so base the next run on the clock itself
+        now = self.hub.clock()
+        if not self.fixed_rate:
+            self.origin = now + self.period
+            self.ticks = 0
+            deadline = self.origin
+        else:
+            ticks = int((now - self.origin) // self.period) + 1
+            # guard against float rounding landing us back on the run that
+            # just fired
+            ticks = max(ticks, self.ticks + 1)
+            self.missed += ticks - self.ticks - 1
+            self.ticks = ticks
+            deadline = self.origin + ticks * self.period
+        # timers are relative to the Hub's time, not the clock
+        ms = max(deadline - self.hub.now(), 0) * 1000
+        self.item = self.hub.scheduled.add(
+            self.hub.coalesce(ms, self.slack), self.fire)
+
+
+class Plugins(object):
+    """
+    The registry of plugins available as attributes of a `Hub`. A plugin is a
+    factory which is called with the Hub the first time the attribute is
+    accessed.
+
+    Plugins are looked up, in order, from those explicitly `register`-ed, the
+    built in plugins, modules named vanilla.<name> which define a __plugin__
+    and finally the 'vanilla.plugins' entry point group. Hits, misses and
+    failures to load a plugin are all cached.
+    """
+    BUILTIN = ('http', 'io', 'process', 'signal', 'tcp')
+    GROUP = 'vanilla.plugins'
+
+    def __init__(self):
+        self.factories = {}
+        self.missing = set()
+        self.failed = {}
+        self.entry_points = None
+
+    def register(self, name, factory):
+        self.factories[name] = factory
+        self.missing.discard(name)
+        self.failed.pop(name, None)
+
+    def lookup(self, name):
+        """
+        Returns the factory for the plugin *name*, or None if there isn't one.
+        Raises the original exception if the plugin failed to load.
+        """
+        factory = self.factories.get(name)
+        if factory is not None:
+            return factory
+        if name in self.missing or name.startswith('_'):
+            return None
+        if name in self.failed:
+            raise self.failed[name]
+        try:
+            factory = self.find(name)
+        except Exception, e:
+            self.failed[name] = e
+            raise
+        if factory is None:
+            self.missing.add(name)
+        else:
+            self.factories[name] = factory
+        return factory
+
+    def find(self, name):
+        module = 'vanilla.' + name
+        if name not in self.BUILTIN:
+            try:
+                found = pkgutil.find_loader(module)
+            except ImportError:
+                found = None
+            if not found:
+                entry_point = self.load_entry_points().get(name)
+                return entry_point and self.load_entry_point(entry_point)
+        return getattr(importlib.import_module(module), '__plugin__', None)
+
+    def load_entry_points(self):
+        """
+        Scans the installed distributions for the 'vanilla.plugins' entry
+        point group, once. Their entry_points.txt are read directly, as
+        importing pkg_resources to do this takes tens of milliseconds.
+        """
+        if self.entry_points is None:
+            import ConfigParser
+            import glob
+            self.entry_points = {}
+            for path in sys.path:
+                path = path or '.'
+                found = glob.glob(
+                    os.path.join(path, '*-info', 'entry_points.txt'))
+                if path.endswith('.egg'):
+                    found.append(
+                        os.path.join(path, 'EGG-INFO', 'entry_points.txt'))
+                for filename in found:
+                    parser = ConfigParser.RawConfigParser()
+                    parser.optionxform = str
+                    try:
+                        parser.read(filename)
+                        items = parser.items(self.GROUP)
+                    except ConfigParser.Error:
+                        continue
+                    for name, target in items:
+                        self.entry_points.setdefault(name, target)
+        return self.entry_points
+
+    @staticmethod
+    def load_entry_point(target):
+        # target is 'module:attr.attr [extras]'
+        module, _, attrs = target.split('[')[0].partition(':')
+        ob = importlib.import_module(module.strip())
+        for attr in filter(None, attrs.strip().split('.')):
+            ob = getattr(ob, attr)
+        return ob
+
+
+plugins = Plugins()
+
+
 class Hub(object):
     """
     A Vanilla Hub is a handle to a self contained world of interwoven
@@ -80,34 +729,91 @@ class Hub(object):
     this Hub is explicit and must be passed to coroutines that need to interact
     with it. This is particularly nice for testing, as it makes it clear what's
     going on, and other tests can't inadvertently effect each other.
+
+    *scheduler* is the factory used to create the Hub's timer queue. It
+    defaults to the heap based `Scheduler`, which is the faster choice in
+    general. `TimingWheel` is slower to add and fire timers, and only wins
+    when there are a large number of pending timeouts, half or more of which
+    are cancelled before they fire. Timers are driven by the Hub's own clock,
+    see `now`.
+
+    Each spawned callable is run on a new green thread. With a *pool_size*,
+    they're run on pooled worker green threads instead, which park
+    themselves once their callable returns, ready to be handed the next one,
+    and *pool_size* caps the number of parked workers kept around. Creating
+    a green thread is cheap, and in benchmarks/spawn.py handing tasks to
+    parked workers is slower than creating new ones, so there's no pool by
+    default.
+
+    Ready tasks are run by priority, see `spawn`. *weights* is the number of
+    tasks each priority level may run per round while other levels are
+    waiting. *budget* is the number of ready tasks the main loop will run
+    before it stops to fire due timers and check for I/O.
+
+    *slack* is how many milliseconds late a timer may fire, so that timers
+    due close together can share a single wakeup, see `coalesce`. It defaults
+    to 0, for timers to fire as close to when they're due as possible.
+
+    *poll* is the factory used to create the Hub's I/O poller. It defaults to
+    the platform's epoll or kqueue based `Poll`. On Linux, `vanilla.poll.uring`
+    uses io_uring when it's available and falls back to `Poll` when it isn't.
+    It's only used for readiness notifications, and isn't faster than epoll.
+
+    Plugins, such as `io`, `tcp` and `http`, are attributes of the Hub which
+    are created on first access, see `Plugins`. *preload* is a list of plugin
+    names to create up front instead, so the first request doesn't pay for
+    importing and setting them up.
     """
-    def __init__(self):
+    def __init__(
+            self, scheduler=Scheduler, pool_size=0, weights=(16, 4, 1),
+            budget=256, slack=0, poll=vanilla.poll.Poll, preload=()):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__))
 
-        self.ready = collections.deque()
-        self.scheduled = Scheduler()
+        self.slack = slack
+        # the number of timers fired in the same wakeup as an earlier one
+        self.coalesced = 0
+
+        self.budget = budget
+        # the number of times the budget ran out with tasks still waiting
+        self.exhausted = 0
+
+        self.pool_size = pool_size
+        self.workers = []
 
-        self.stopped = self.state()
+        self.clock = get_clock()
+        self.time = self.clock()
 
-        self.registered = {}
-        self.poll = vanilla.poll.Poll()
+        self.ready = Ready(weights)
+        self.scheduled = scheduler(clock=self.now)
+
+        self.stopped = self.value()
+
+        self.registered = Descriptors()
+        self.poll = poll()
         self.loop = greenlet(self.main)
 
+        for name in preload:
+            getattr(self, name)
+
     def __getattr__(self, name):
-        # facilitates dynamic plugin look up
+        # facilitates dynamic plugin look up. the registry caches misses, so
+        # probing for an attribute that isn't a plugin is cheap and quiet
         try:
-            package = '.'.join(__name__.split('.')[:-1])
-            module = importlib.import_module('.'+name, package=package)
-            plugin = module.__plugin__(self)
-            setattr(self, name, plugin)
-            return plugin
+            factory = plugins.lookup(name)
+            plugin = factory and factory(self)
         except Exception, e:
-            log.exception(e)
+            raise AttributeError(
+                "'Hub' object has no attribute '{name}'\n"
+                "The plugin named {name} failed to load: {e!r}".format(
+                    name=name, e=e))
+        if factory is None:
             raise AttributeError(
                 "'Hub' object has no attribute '{name}'\n"
                 "You may be trying to use a plugin named vanilla.{name}. "
                 "If you are, you still need to install it".format(
                     name=name))
+        setattr(self, name, plugin)
+        return plugin
 
     def pipe(self):
         """
@@ -163,9 +869,18 @@ class Hub(object):
         """
         @self.producer
         def _(sender):
+            # pulses are due at whole periods from the start, so the time
+            # taken to deliver each doesn't accumulate as drift. if the Recver
+            # falls a whole period behind, the pulses it missed are skipped
+            period = ms / 1000.0
+            due = self.now()
             while True:
+                due += period
+                now = self.now()
+                if due < now:
+                    due += (now - due) // period * period + period
                 try:
-                    self.sleep(ms)
+                    self.sleep((due - now) * 1000)
                 except vanilla.exception.Halt:
                     break
                 sender.send(item)
@@ -178,7 +893,6 @@ class Hub(object):
                 f()
         sender, recver = self.pipe()
         self.spawn(consume, recver, f)
-        sender.trigger = functools.partial(sender.send, True)
         return sender
 
     def dealer(self):
@@ -201,22 +915,10 @@ class Hub(object):
 
     def channel(self, size=-1):
         """
-        ::
-
-            send --\    +---------+  /--> recv
-                    +-> | Channel | -+
-            send --/    +---------+  \--> recv
-
-        A Channel can have many senders and many recvers. By default it is
-        unbuffered, but you can create buffered Channels by specifying a size.
-        They're structurally equivalent to channels in Go. It's implementation
-        is *literally* a `Router`_ piped to a `Dealer`_, with an optional
-        `Queue`_ in between.
+        Returns a `Channel`_ `Pair`_, with a buffer of *size* items if *size*
+        is greater than 0.
         """
-        sender, recver = self.router()
-        if size > 0:
-            recver = recver.pipe(self.queue(size))
-        return vanilla.message.Pair(sender, recver.pipe(self.dealer()))
+        return vanilla.message.Channel(self, size)
 
     def serialize(self, f):
         """
@@ -239,16 +941,30 @@ class Hub(object):
 
         return _
 
-    def broadcast(self):
-        return vanilla.message.Broadcast(self)
+    def broadcast(self, size=1, policy=vanilla.message.BLOCK):
+        """
+        Returns a `Broadcast`_, whose subscribers each have a buffer of
+        *size* items, and *policy* for when it's full.
+        """
+        return vanilla.message.Broadcast(self, size=size, policy=policy)
 
     def state(self, state=vanilla.message.NoState):
         return vanilla.message.State(self, state=state)
 
-    def value(self):
-        return vanilla.message.Value(self)
+    def value(self, value=vanilla.message.NoState):
+        """
+        Returns a `Value`_, optionally set to *value*.
+        """
+        return vanilla.message.Value(self, value)
+
+    def selector(self, ends=()):
+        """
+        Returns a `Selector`_ over *ends*, for selecting over the same ends
+        repeatedly.
+        """
+        return vanilla.message.Selector(self, ends)
 
-    def select(self, ends, timeout=-1):
+    def select(self, ends, timeout=-1, fair=False, weights=None):
         """
         An end is either a `Sender`_ or a `Recver`_. select takes a list of
         *ends* and blocks until *one* of them is ready. The select will block
@@ -274,12 +990,36 @@ class Hub(object):
                         current = value
                     elif end == downstream:
                         end.send(current)
+
+        When more than one end is ready, the first in *ends* is chosen. In a
+        busy loop that can starve the ends towards the back, such as a
+        control pipe behind a hot upstream. Pass *fair=True* to start looking
+        from a random end instead, so each ready end has an even chance.
+        *weights*, a list with a weight for each end, picks between the
+        ready ends in proportion to their weight instead::
+
+            # upstream gets ~3/4 of the turns while both are busy
+            end, value = h.select([upstream, control], weights=[3, 1])
+
+        If no end is ready, the first to become ready is chosen either way.
         """
-        for end in ends:
-            if end.ready:
+        if weights is not None:
+            end = self.pick(ends, weights)
+            if end is not None:
                 return end, isinstance(
                     end, vanilla.message.Recver) and end.recv() or None
 
+        else:
+            if fair and ends:
+                # imported here, as on Python 2 random imports hashlib
+                import random
+                start = random.randrange(len(ends))
+                ends = ends[start:] + ends[:start]
+            for end in ends:
+                if end.ready:
+                    return end, isinstance(
+                        end, vanilla.message.Recver) and end.recv() or None
+
         for end in ends:
             end.select()
 
@@ -291,10 +1031,24 @@ class Hub(object):
 
         return fired, item
 
-    def pause(self, timeout=-1):
+    def pick(self, ends, weights):
+        # a weighted random choice of the ready *ends*, or None
+        ready = [
+            (weight, end) for end, weight in zip(ends, weights) if end.ready]
+        if not ready:
+            return None
+        import random
+        at = random.uniform(0, sum(weight for weight, _ in ready))
+        for weight, end in ready:
+            at -= weight
+            if at < 0:
+                return end
+        return end
+
+    def pause(self, timeout=-1, slack=None):
         if timeout > -1:
             item = self.scheduled.add(
-                timeout,
+                self.coalesce(timeout, slack),
                 getcurrent(),
                 vanilla.exception.Timeout('timeout: %s' % timeout))
 
@@ -310,26 +1064,49 @@ class Hub(object):
                 # since we didn't timeout, remove ourselves from scheduled
                 self.scheduled.remove(item)
 
-        # TODO: rework State's is set test to be more natural
-        if self.stopped.recver.ready:
+        if self.stopped.ready:
             raise vanilla.exception.Stop(
                 'Hub stopped while we were paused. There must be a deadlock.')
 
         return resume
 
+    def resume_later(self, target=None, *a):
+        # queue a green thread, the current one by default, to be resumed at
+        # its own priority. *a* is what its switch will return
+        if target is None:
+            target = getcurrent()
+        self.ready.append(
+            (target, a), getattr(target, 'priority', PRIORITY_NORMAL))
+
+    def wake(self, target, *a):
+        """
+        Like `resume_later`, but returns a `Wake` which can be cancelled until
+        *target* is resumed.
+
+        It's for waking a green thread which may also be waiting on something
+        else, such as in a `select` over many ends. If the green thread is
+        resumed by something else first, whatever it was waiting on cancels
+        its wake and takes back what the wake was carrying. Otherwise the
+        stale wake would resume it later, from an unrelated pause.
+        """
+        wake = Wake(target, a)
+        self.ready.append(
+            (wake, ()), getattr(target, 'priority', PRIORITY_NORMAL))
+        return wake
+
     def switch_to(self, target, *a):
-        self.ready.append((getcurrent(), ()))
+        self.resume_later()
         return target.switch(*a)
 
     def throw_to(self, target, *a):
-        self.ready.append((getcurrent(), ()))
+        self.resume_later()
         """
         if len(a) == 1 and isinstance(a[0], preserve_exception):
             return target.throw(a[0].typ, a[0].val, a[0].tb)
         """
         return target.throw(*a)
 
-    def spawn(self, f, *a):
+    def spawn(self, f, *a, **kw):
         """
         Schedules a new green thread to be created to run *f(\*a)* on the next
         available tick::
@@ -340,10 +1117,36 @@ class Hub(object):
             p = h.pipe()
             h.spawn(echo, p, 'hi')
             p.recv() # returns 'hi'
+
+        An optional *priority* keyword can be one of PRIORITY_HIGH,
+        PRIORITY_NORMAL (the default) or PRIORITY_LOW. Higher priority green
+        threads are run first, both when they're spawned and whenever they're
+        resumed::
+
+            h.spawn(ship_logs, priority=vanilla.core.PRIORITY_LOW)
         """
-        self.ready.append((f, a))
+        self.ready.append((f, a), kw.get('priority', PRIORITY_NORMAL))
 
-    def spawn_later(self, ms, f, *a):
+    def stats(self):
+        """
+        Returns a dict of counters describing the Hub's current load:
+
+            - *ready*: the number of tasks waiting at each priority level
+            - *served*: the number of tasks run from each priority level
+            - *scheduled*: the number of pending timers
+            - *exhausted*: the number of times the main loop's run budget
+              ran out with tasks still waiting
+            - *coalesced*: the number of wakeups saved by firing timers
+              together
+        """
+        return {
+            'ready': self.ready.depths(),
+            'served': list(self.ready.served),
+            'scheduled': len(self.scheduled),
+            'exhausted': self.exhausted,
+            'coalesced': self.coalesced, }
+
+    def spawn_later(self, ms, f, *a, **kw):
         """
         Spawns a callable on a new green thread, scheduled for *ms*
         milliseconds in the future::
@@ -354,10 +1157,89 @@ class Hub(object):
             p = h.pipe()
             h.spawn_later(50, echo, p, 'hi')
             p.recv() # returns 'hi' after 50ms
+
+        Returns a `Timer` which can be used to cancel, or reschedule, the
+        callable before it fires::
+
+            timer = h.spawn_later(1000, flush)
+            timer.cancel()
+
+        An optional *slack* keyword overrides the Hub's timer slack for this
+        timer, see `coalesce`.
+        """
+        return Timer(self, ms, f, a, slack=kw.get('slack'))
+
+    def every(self, ms, f, *a, **kw):
+        """
+        Runs *f(\*a)* every *ms* milliseconds, starting *ms* milliseconds from
+        now. A run isn't started until the previous one has returned.
+
+        By default runs are at a fixed rate: they're due at whole periods from
+        the first run, regardless of how long each takes, so a heartbeat stays
+        on cadence. Runs which fall a whole period or more behind are skipped
+        and counted. Pass *fixed_rate=False* to instead wait *ms* milliseconds
+        after each run returns before the next.
+
+        Returns a `Periodic` handle, which can be cancelled::
+
+            heartbeat = h.every(1000, send_heartbeat)
+            ...
+            heartbeat.missed # the number of skipped heartbeats
+            heartbeat.cancel()
+
+        An optional *slack* keyword overrides the Hub's timer slack for each
+        run, see `coalesce`.
         """
-        self.scheduled.add(ms, f, *a)
+        return Periodic(
+            self, ms, f, a,
+            fixed_rate=kw.get('fixed_rate', True), slack=kw.get('slack'))
 
-    def sleep(self, ms=1):
+    def coalesce(self, ms, slack=None):
+        """
+        Returns the delay to schedule a timer due in *ms* milliseconds with,
+        given it may fire up to *slack* milliseconds late. *slack* defaults to
+        the Hub's.
+
+        The timer is pushed back to the next multiple of *slack* on the Hub's
+        clock. Timers with the same slack that are due within the same window
+        then come due at the same moment and are fired in a single wakeup of
+        the main loop, rather than one each::
+
+            h = vanilla.Hub(slack=10)
+            h.sleep(3) # sleeps for somewhere between 3 and 13ms
+        """
+        if slack is None:
+            slack = self.slack
+        # a timeout of 0 is a poll, and shouldn't be held back
+        if slack <= 0 or ms <= 0:
+            return ms
+        slack = slack / 1000.0
+        due = self.time + ms / 1000.0
+        return (math.ceil(due / slack) * slack - self.time) * 1000
+
+    def now(self):
+        """
+        Returns the Hub's current time in seconds. The time is read from a
+        monotonic clock, so it's unaffected by changes to the system's wall
+        clock, and is only sampled once per iteration of the Hub's main loop,
+        which makes it cheap to call. Note this means it doesn't advance while
+        a green thread runs without yielding::
+
+            start = h.now()
+            h.sleep(50)
+            h.now() - start # returns roughly 0.05
+        """
+        return self.time
+
+    def update_time(self):
+        """
+        Resamples the Hub's clock. The main loop does this every iteration;
+        call it directly if a green thread has been busy for long enough that
+        the current `now` is too stale to base a timeout on.
+        """
+        self.time = self.clock()
+
+    def sleep(self, ms=1, slack=None):
         """
         Pauses the current green thread for *ms* milliseconds::
 
@@ -371,45 +1253,164 @@ class Hub(object):
 
             p.recv() # returns '1'
             p.recv() # returns '2' after 50 ms
+
+        Sleeping for 0 ms is the same as `yield_`. An optional *slack*
+        overrides the Hub's timer slack, see `coalesce`.
         """
-        self.scheduled.add(ms, getcurrent())
+        if ms <= 0:
+            return self.yield_()
+        self.scheduled.add(self.coalesce(ms, slack), getcurrent())
         self.loop.switch()
 
+    def yield_(self):
+        """
+        Gives other ready green threads a turn, and then resumes the current
+        one. Unlike sleeping, this doesn't involve the scheduler at all::
+
+            for item in work:
+                process(item)
+                h.yield_()
+        """
+        assert getcurrent() != self.loop, "cannot yield the main loop"
+        self.resume_later()
+        self.loop.switch()
+
+    def watch(self, fd, *masks):
+        """
+        Registers *fd* with the Hub's poller for the events in *masks*, if it
+        isn't already, and returns its `Descriptor`. The descriptor stays
+        registered until `unregister` is called.
+        """
+        descriptor = self.registered.get(fd)
+        if descriptor is None:
+            descriptor = Descriptor(fd)
+            self.registered.add(descriptor)
+        new = [mask for mask in masks if mask not in descriptor.masks]
+        if new:
+            if descriptor.masks:
+                self.poll.modify(fd, *(descriptor.masks + new))
+            else:
+                self.poll.register(fd, *new)
+            descriptor.masks.extend(new)
+        return descriptor
+
+    def wait(self, fd, mask, timeout=-1):
+        descriptor = self.watch(fd, mask)
+        if mask in descriptor.latched:
+            # the event arrived while we weren't waiting
+            descriptor.latched.remove(mask)
+            return
+        current = getcurrent()
+        assert mask not in descriptor.waiting, \
+            'another green thread is already waiting on fd %s' % fd
+        descriptor.waiting[mask] = current
+        try:
+            self.pause(timeout=timeout)
+        finally:
+            # the main loop clears this when it wakes us, but not if we timed
+            # out or had an exception thrown in
+            if descriptor.waiting.get(mask) is current:
+                del descriptor.waiting[mask]
+
+    def wait_readable(self, fd, timeout=-1):
+        """
+        Blocks the current green thread until *fd* is readable, or has an
+        error or hang up pending. The fd is registered with the Hub's poller
+        on first use and stays registered until `unregister` is called.
+
+        The poller is edge triggered, so wait once a read has returned
+        EAGAIN. Events which arrive while nothing is waiting are latched, so
+        the next wait returns straight away, and an event is never missed::
+
+            while True:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    h.wait_readable(fd)
+                    continue
+                ...
+
+        Raises `Closed` if *fd* is unregistered while waiting, and `Timeout`
+        if the optional *timeout*, in milliseconds, is reached.
+        """
+        return self.wait(fd, vanilla.poll.POLLIN, timeout=timeout)
+
+    def wait_writable(self, fd, timeout=-1):
+        """
+        Blocks the current green thread until *fd* is writable. See
+        `wait_readable`.
+        """
+        return self.wait(fd, vanilla.poll.POLLOUT, timeout=timeout)
+
     def register(self, fd, *masks):
+        """
+        Registers *fd* for the events in *masks* and returns a `Recver`_ for
+        each, which has True sent on it whenever the event is ready. Prefer
+        `wait_readable` and `wait_writable`, which switch directly to the
+        waiting green thread without a Pipe in between.
+        """
+        descriptor = self.watch(fd, *masks)
         ret = []
-        self.registered[fd] = {}
         for mask in masks:
             sender, recver = self.pipe()
-            self.registered[fd][mask] = sender
+            descriptor.pipes[mask] = sender
+            self.spawn(self.forward, fd, mask, sender)
             ret.append(recver)
-        self.poll.register(fd, *masks)
         if len(ret) == 1:
             return ret[0]
         return ret
 
+    def forward(self, fd, mask, sender):
+        # feeds a Pipe handed out by register. while the Pipe's Recver is
+        # busy, we're blocked in send and further events are latched
+        while True:
+            try:
+                self.wait(fd, mask)
+                sender.send(True)
+            except vanilla.exception.Halt:
+                return
+
     def unregister(self, fd):
-        if fd in self.registered:
-            masks = self.registered.pop(fd)
+        descriptor = self.registered.pop(fd)
+        if descriptor is None:
+            return
+        try:
+            self.poll.unregister(fd, *descriptor.masks)
+        except:
+            pass
+        for f, a in descriptor.closers:
             try:
-                self.poll.unregister(fd, *(masks.keys()))
-            except:
-                pass
-            for mask in masks:
-                masks[mask].close()
+                f(*a)
+            except Exception, e:
+                self.log.warn('Exception in onclose', exc_info=e)
+        for sender in descriptor.pipes.values():
+            sender.close()
+        while descriptor.waiting:
+            _, waiting = descriptor.waiting.popitem()
+            self.throw_to(waiting, vanilla.exception.Closed('closed'))
 
     def stop(self):
         self.sleep(1)
 
-        for fd, masks in self.registered.items():
-            for mask, sender in masks.items():
+        for descriptor in self.registered.values():
+            for sender in descriptor.pipes.values():
                 sender.stop()
+            while descriptor.waiting:
+                _, waiting = descriptor.waiting.popitem()
+                self.throw_to(waiting, vanilla.exception.Stop('stop'))
+            # descriptors nothing was waiting on are simply unregistered
+            self.unregister(descriptor.fd)
 
         while self.scheduled:
             task, a = self.scheduled.pop()
-            self.throw_to(task, vanilla.exception.Stop('stop'))
+            # callables which haven't been spawned yet are simply dropped
+            if isinstance(task, greenlet):
+                self.throw_to(task, vanilla.exception.Stop('stop'))
 
         try:
-            self.stopped.recv()
+            self.stopped.get()
         except vanilla.exception.Halt:
             return
 
@@ -421,20 +1422,81 @@ class Hub(object):
         try:
             if isinstance(task, greenlet):
                 task.switch(*a)
+            elif type(task) is Wake:
+                task.run()
+            elif self.workers:
+                self.workers.pop().switch(Hub.Task, task, a)
+            elif self.pool_size:
+                # the task is passed in a list, which the worker empties, as
+                # a green thread's first switch arguments are kept alive for
+                # as long as it runs
+                greenlet(self.work).switch([task, a])
             else:
-                greenlet(task).switch(*a)
+                task = greenlet(task)
+                if self.ready.level != PRIORITY_NORMAL:
+                    task.priority = self.ready.level
+                task.switch(*a)
         except Exception, e:
             self.log.warn('Exception leaked back to main loop', exc_info=e)
 
+    class Task(object):
+        """marks a task handed to a parked worker"""
+
+    def work(self, first):
+        """
+        The body of a pooled worker. Runs the *first* task it's started with,
+        a list of [callable, args], and then parks in the pool until
+        `run_task` hands it the next one.
+        """
+        current = getcurrent()
+        f, a = first
+        del first[:]
+        # the priority the worker's tasks are resumed at is its own, so it's
+        # only set when it changes
+        priority = PRIORITY_NORMAL
+        while True:
+            if self.ready.level != priority:
+                priority = current.priority = self.ready.level
+            try:
+                f(*a)
+            except Exception, e:
+                self.log.warn('Exception leaked back to main loop', exc_info=e)
+                # don't let the traceback keep the task's frames alive
+                del e
+                sys.exc_clear()
+            # drop references to the finished task so anything it was
+            # holding can be garbage collected while we're parked
+            f = a = None
+
+            if len(self.workers) >= self.pool_size:
+                return
+
+            self.workers.append(current)
+            while True:
+                task = self.loop.switch()
+                # anything else which reaches a parked worker, such as a
+                # stray switch, isn't a task; ignore it
+                if type(task) is tuple and len(task) == 3 and \
+                        task[0] is Hub.Task:
+                    break
+            _, f, a = task
+            task = None
+
     def main(self):
         """
         Scheduler steps:
-            - run ready until exhaustion
+            - sample the Hub's clock
 
-            - if there's something scheduled
-                - run overdue scheduled immediately
-                - or if there's nothing registered, sleep until next scheduled
-                  and then go back to ready
+            - run ready tasks, until either there are none left or the run
+              budget is used up
+
+            - fire every overdue scheduled
+
+            - if there are still ready tasks, poll registered without
+              blocking and go back to the top
+
+            - if there's something scheduled and nothing registered, sleep
+              until the next scheduled and then go back to the top
 
             - if there's nothing registered and nothing scheduled, we've
               deadlocked, so stopped
@@ -444,32 +1506,53 @@ class Hub(object):
         """
 
         while True:
-            while self.ready:
+            self.update_time()
+
+            # a ready queue that keeps refilling shouldn't be able to starve
+            # timers and I/O, so only run up to the budget
+            budget = self.budget
+            while budget and self.ready:
                 task, a = self.ready.popleft()
                 self.run_task(task, *a)
+                budget -= 1
 
-            if self.scheduled:
-                timeout = self.scheduled.timeout()
-                # run overdue scheduled immediately
-                if timeout < 0:
-                    task, a = self.scheduled.pop()
-                    self.run_task(task, *a)
+            # fire everything that's overdue. note sleep(0) style timers,
+            # added while firing, aren't overdue until the clock moves on
+            fired = 0
+            while self.scheduled and self.scheduled.timeout() < 0:
+                task, a = self.scheduled.pop()
+                # callables spawned later run at normal priority
+                self.ready.level = PRIORITY_NORMAL
+                self.run_task(task, *a)
+                fired += 1
+            if fired > 1:
+                self.coalesced += fired - 1
+
+            if self.ready:
+                if not budget:
+                    self.exhausted += 1
+                # there's still work waiting, so check for I/O but don't block
+                if not self.registered:
                     continue
+                timeout = 0
 
+            elif self.scheduled:
+                timeout = self.scheduled.timeout()
                 # if nothing registered, just sleep until next scheduled
                 if not self.registered:
                     time.sleep(timeout)
-                    task, a = self.scheduled.pop()
-                    self.run_task(task, *a)
                     continue
+                # round up to the poller's millisecond resolution so we don't
+                # wake just short of the next scheduled and spin
+                timeout = math.ceil(timeout * 1000) / 1000.0
+
             else:
+                # TODO: add better handling for deadlock
+                if not self.registered:
+                    self.stopped.set(True)
+                    return
                 timeout = -1
 
-            # TODO: add better handling for deadlock
-            if not self.registered:
-                self.stopped.send(True)
-                return
-
             # run poll
             events = None
             while True:
@@ -483,22 +1566,25 @@ class Hub(object):
                         break
                     continue
 
-            if self.ready:
-                # an interrupt handler must have added work, handle first
-                continue
-
-            if not events:
-                # timeout
-                task, a = self.scheduled.pop()
-                self.run_task(task, *a)
-
-            else:
-                for fd, mask in events:
-                    if fd in self.registered:
-                        masks = self.registered[fd]
-                        if mask == vanilla.poll.POLLERR:
-                            for sender in masks.values():
-                                sender.close()
-                        else:
-                            if masks[mask].ready:
-                                masks[mask].send(True)
+            # if there are no events we timed out, and the next scheduled is
+            # run on the next iteration, after the clock has been resampled
+            for fd, mask in events or ():
+                descriptor = self.registered.get(fd)
+                if descriptor is None:
+                    continue
+                if mask == vanilla.poll.POLLERR:
+                    for sender in descriptor.pipes.values():
+                        sender.close()
+                    # wake everything waiting, and latch the error for
+                    # anything that isn't; the next read or write will see it
+                    descriptor.latched.update(descriptor.masks)
+                    while descriptor.waiting:
+                        waited, waiting = descriptor.waiting.popitem()
+                        descriptor.latched.discard(waited)
+                        self.run_task(waiting)
+                else:
+                    waiting = descriptor.waiting.pop(mask, None)
+                    if waiting is None:
+                        descriptor.latched.add(mask)
+                    else:
+                        self.run_task(waiting)
@@ -1,13 +1,7 @@
 import collections
 import functools
-import urlparse
 import logging
-import hashlib
-import base64
-import urllib
 import struct
-import uuid
-import ssl
 import os
 
 import vanilla.exception
@@ -31,6 +25,7 @@ class __plugin__(object):
     # TODO: hacking in convenience for example, still need to add test
     # TODO: ensure connection is closed after the get is done
     def get(self, uri, params=None, headers=None):
+        import urlparse
         parsed = urlparse.urlsplit(uri)
         conn = self.connect('%s://%s' % (parsed.scheme, parsed.netloc))
         return conn.get(parsed.path, params=params, headers=headers)
@@ -39,8 +34,7 @@ class __plugin__(object):
         server = self.hub.tcp.listen(host=host, port=port)
         ret = server.map(
             lambda conn: HTTPServer(self.hub, conn))
-        ret.port = server.port
-        return ret
+        return self.hub.tcp.serve(ret, server.port)
 
 
 REASON_PHRASES = {
@@ -182,6 +176,11 @@ class HTTPClient(HTTPSocket):
             return 'HTTPClient.Response(status=%r)' % (self.status,)
 
     def __init__(self, hub, url):
+        # the client's dependencies are imported on first use, so they don't
+        # slow down importing vanilla.http for servers
+        import urlparse
+        import urllib
+
         self.hub = hub
 
         parsed = urlparse.urlsplit(url)
@@ -196,6 +195,7 @@ class HTTPClient(HTTPSocket):
         # TODO: this shouldn't block on the SSL handshake
         if parsed.scheme == 'https':
             # TODO: what a mess
+            import ssl
             conn = self.socket.sender.fd.conn
             conn = ssl.wrap_socket(conn)
             conn.setblocking(0)
@@ -298,6 +298,7 @@ class HTTPClient(HTTPSocket):
             request_headers.update(headers)
 
         if params:
+            import urllib
             path += '?' + urllib.urlencode(params)
 
         request = '%s %s %s\r\n' % (method, path, HTTP_VERSION)
@@ -316,6 +317,7 @@ class HTTPClient(HTTPSocket):
         if auth:
             if not headers:
                 headers = {}
+            import base64
             headers['Authorization'] = \
                 'Basic ' + base64.b64encode('%s:%s' % auth)
         return self.request('GET', path, params, headers, None)
@@ -330,6 +332,8 @@ class HTTPClient(HTTPSocket):
         return self.request('DELETE', path, params, headers, None)
 
     def websocket(self, path='/', params=None, headers=None):
+        import base64
+        import uuid
         key = base64.b64encode(uuid.uuid4().bytes)
 
         headers = headers or {}
@@ -476,6 +480,8 @@ class WebSocket(object):
 
     @staticmethod
     def accept_key(key):
+        import hashlib
+        import base64
         value = key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
         return base64.b64encode(hashlib.sha1(value).digest())
 
@@ -1,7 +1,7 @@
 import socket
 import fcntl
 import errno
-import ssl
+import sys
 import os
 
 import vanilla.exception
@@ -43,13 +43,17 @@ class FD_from_fileno_in(object):
     def __init__(self, hub, fileno):
         self.hub = hub
         self.fileno = fileno
+        self.closed = False
         unblock(self.fileno)
-        self.pollin = hub.register(self.fileno, vanilla.poll.POLLIN)
+        hub.watch(self.fileno, vanilla.poll.POLLIN).onclose(self.close)
 
     def read(self, n):
         return os.read(self.fileno, n)
 
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
         try:
             os.close(self.fileno)
         except OSError:
@@ -61,13 +65,17 @@ class FD_from_fileno_out(object):
     def __init__(self, hub, fileno):
         self.hub = hub
         self.fileno = fileno
+        self.closed = False
         unblock(self.fileno)
-        self.pollout = hub.register(self.fileno, vanilla.poll.POLLOUT)
+        hub.watch(self.fileno, vanilla.poll.POLLOUT).onclose(self.close)
 
     def write(self, data):
         return os.write(self.fileno, data)
 
     def close(self):
+        if self.closed:
+            return
+        self.closed = True
         try:
             os.close(self.fileno)
         except OSError:
@@ -82,8 +90,9 @@ class FD_from_socket(object):
         self.closed = False
         self.fileno = self.conn.fileno()
         unblock(self.fileno)
-        self.pollin, self.pollout = hub.register(
-            self.fileno, vanilla.poll.POLLIN, vanilla.poll.POLLOUT)
+        hub.watch(
+            self.fileno,
+            vanilla.poll.POLLIN, vanilla.poll.POLLOUT).onclose(self.close)
 
     def read(self, n):
         return self.conn.recv(n)
@@ -104,10 +113,6 @@ class Sender(object):
         self.fd = fd
         self.hub = fd.hub
 
-        self.gate = self.hub.router().pipe(self.hub.state())
-        self.fd.pollout.pipe(self.gate)
-        self.fd.pollout.onclose(self.close)
-
         @self.hub.serialize
         def send(data, timeout=-1):
             # TODO: test timeout
@@ -116,7 +121,10 @@ class Sender(object):
                     n = self.fd.write(data)
                 except (socket.error, OSError), e:
                     if e.errno == errno.EAGAIN:
-                        self.gate.clear().recv()
+                        try:
+                            self.hub.wait_writable(self.fd.fileno)
+                        except vanilla.exception.Halt:
+                            raise vanilla.exception.Closed()
                         continue
                     self.close()
                     raise vanilla.exception.Closed()
@@ -129,39 +137,56 @@ class Sender(object):
         recver.consume(self.send)
 
     def close(self):
-        self.gate.close()
         self.fd.close()
 
 
+def is_ssl_error(e):
+    # ssl is slow to import, and only needs to be for ssl wrapped sockets
+    ssl = sys.modules.get('ssl')
+    return ssl is not None and isinstance(e, ssl.SSLError)
+
+
 def Recver(fd):
     hub = fd.hub
-    sender, recver = hub.pipe()
+    sender, recver = vanilla.message.Pipe(
+        hub, recver=vanilla.message.Stream.Recver)
 
     recver.onclose(fd.close)
 
     @hub.spawn
     def _():
-        for _ in fd.pollin:
-            while True:
+        # everything that can be read without blocking is passed on as a
+        # single batch
+        chunks = []
+        while True:
+            try:
+                data = fd.read(16384)
+            except (socket.error, OSError), e:
+                """
+                # TODO: investigate handling non-blocking ssl correctly
+                # perhaps SSL_set_fd() ??
+                """
+                if e.errno != errno.EAGAIN and not is_ssl_error(e):
+                    break
+                if chunks:
+                    sender.send_many(chunks)
+                    chunks = []
                 try:
-                    data = fd.read(16384)
-                except (socket.error, OSError), e:
-                    if e.errno == errno.EAGAIN:
-                        break
-                    """
-                    # TODO: investigate handling non-blocking ssl correctly
-                    # perhaps SSL_set_fd() ??
-                    """
-                    if isinstance(e, ssl.SSLError):
-                        break
-                    sender.close()
-                    return
-
-                if not data:
-                    sender.close()
-                    return
-
-                sender.send(data)
+                    hub.wait_readable(fd.fileno)
+                except vanilla.exception.Halt:
+                    break
+                continue
+
+            if not data:
+                break
+
+            chunks.append(data)
+            if len(chunks) == 16:
+                sender.send_many(chunks)
+                chunks = []
+
+        if chunks:
+            sender.send_many(chunks)
         sender.close()
 
-    return vanilla.message.Stream(recver)
+    return recver
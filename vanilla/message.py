@@ -2,6 +2,7 @@ import collections
 import weakref
 
 from greenlet import getcurrent
+from greenlet import greenlet
 
 import vanilla.exception
 
@@ -43,6 +44,9 @@ class Pair(Pair):
         """
         return self.sender.send(item, timeout=timeout)
 
+    def send_many(self, items, timeout=-1):
+        return self.sender.send_many(items, timeout=timeout)
+
     def clear(self):
         self.sender.clear()
         return self
@@ -54,6 +58,9 @@ class Pair(Pair):
         """
         return self.recver.recv(timeout=timeout)
 
+    def recv_batch(self, max_items, timeout=-1):
+        return self.recver.recv_batch(max_items, timeout=timeout)
+
     def recv_n(self, n, timeout=-1):
         return self.recver.recv_n(n, timeout=timeout)
 
@@ -71,14 +78,40 @@ class Pair(Pair):
         """
         return self._replace(recver=self.recver.pipe(target))
 
-    def map(self, f):
+    def map(self, f, fuse=True):
         """
         Maps this Pair with *f*'; see :meth:`vanilla.core.Recver.map`
 
         Returns a new Pair of our current Sender and the mapped target's
         Recver.
         """
-        return self._replace(recver=self.recver.map(f))
+        return self._replace(recver=self.recver.map(f, fuse=fuse))
+
+    def filter(self, f, fuse=True):
+        """
+        Filters this Pair with *f*; see :meth:`vanilla.core.Recver.filter`
+        """
+        return self._replace(recver=self.recver.filter(f, fuse=fuse))
+
+    def flat_map(self, f, fuse=True):
+        """
+        Flat maps this Pair with *f*; see :meth:`vanilla.core.Recver.flat_map`
+        """
+        return self._replace(recver=self.recver.flat_map(f, fuse=fuse))
+
+    def batch(self, max_items, max_ms):
+        """
+        Batches this Pair; see :meth:`vanilla.core.Recver.batch`
+        """
+        return self._replace(recver=self.recver.batch(max_items, max_ms))
+
+    def map_concurrent(self, f, concurrency=8, ordered=True):
+        """
+        Maps this Pair with *f*, concurrently; see
+        :meth:`vanilla.core.Recver.map_concurrent`
+        """
+        return self._replace(recver=self.recver.map_concurrent(
+            f, concurrency=concurrency, ordered=ordered))
 
     def consume(self, f):
         """
@@ -133,18 +166,26 @@ class Pipe(object):
     """
     __slots__ = [
         'hub', 'recver', 'recver_current', 'sender', 'sender_current',
-        'closed', 'closers']
+        'closed', 'closers', 'pending']
 
-    def __new__(cls, hub):
+    def __new__(cls, hub, sender=None, recver=None):
+        """
+        *sender* and *recver* are the classes to use for each end, so that
+        specialized ends, such as the `Dealer`_'s Recver, are created with the
+        right shape up front.
+        """
         self = super(Pipe, cls).__new__(cls)
         self.hub = hub
         self.closed = False
+        self.closers = None
+        # the items of a send_many which are still to be received
+        self.pending = None
 
-        recver = Recver(self)
+        recver = (recver or Recver)(self)
         self.recver = weakref.ref(recver, self.on_abandoned)
         self.recver_current = None
 
-        sender = Sender(self)
+        sender = (sender or Sender)(self)
         self.sender = weakref.ref(sender, self.on_abandoned)
         self.sender_current = None
 
@@ -162,6 +203,10 @@ class Pipe(object):
 
 
 class End(object):
+    # ends are created for every pipe, so they're kept flat: all state lives
+    # in slots, and specialized ends are subclasses which declare their own
+    __slots__ = ['middle', '__weakref__']
+
     def __init__(self, pipe):
         self.middle = pipe
 
@@ -177,9 +222,10 @@ class End(object):
     def ready(self):
         if self.middle.closed:
             raise vanilla.exception.Closed
-        if self.other is None:
+        other = self.other
+        if other is None:
             raise vanilla.exception.Abandoned
-        return bool(self.other.current)
+        return other.peak is not None
 
     def select(self):
         assert self.current is None
@@ -195,6 +241,9 @@ class End(object):
 
     @property
     def peak(self):
+        """
+        The green thread waiting on this end, or None.
+        """
         return self.current
 
     def pause(self, timeout=-1):
@@ -206,20 +255,19 @@ class End(object):
         return ret
 
     def onclose(self, f, *a, **kw):
-        if not hasattr(self.middle, 'closers'):
-            self.middle.closers = [(f, a, kw)]
-        else:
-            self.middle.closers.append((f, a, kw))
+        if self.middle.closers is None:
+            self.middle.closers = []
+        self.middle.closers.append((f, a, kw))
 
     def close(self, exception=vanilla.exception.Closed):
-        closers = getattr(self.middle, 'closers', [])
-        if closers:
-            del self.middle.closers
+        closers = self.middle.closers or []
+        self.middle.closers = None
 
         self.middle.closed = True
 
-        if self.other is not None and bool(self.other.current):
-            self.hub.throw_to(self.other.current, exception)
+        other = self.other
+        if other is not None and other.peak is not None:
+            self.hub.throw_to(other.peak, exception)
 
         for f, a, kw in closers:
             try:
@@ -232,7 +280,7 @@ class End(object):
 
 
 class Sender(End):
-    __slots__ = ['middle', 'upstream']
+    __slots__ = ['upstream']
 
     @property
     def current(self):
@@ -251,17 +299,84 @@ class Sender(End):
         Send an *item* on this pair. This will block unless our Rever is ready,
         either forever or until *timeout* milliseconds.
         """
-        if not self.ready:
+        # this is the hot path for all message passing, so the checks made
+        # by ready and the Hub's switch_to are inlined
+        middle = self.middle
+        if middle.closed:
+            raise vanilla.exception.Closed
+        other = middle.recver()
+        if other is None:
+            raise vanilla.exception.Abandoned
+
+        target = other.peak
+        if target is None:
+            # don't hold our Recver while we wait, so that it can still be
+            # abandoned
+            other = None
             self.pause(timeout=timeout)
+            middle = self.middle
+            other = middle.recver()
+            target = other.peak
 
         if isinstance(item, Exception):
-            return self.hub.throw_to(self.other.peak, item)
+            return middle.hub.throw_to(target, item)
+
+        middle.hub.resume_later()
+        return target.switch(other, item)
 
-        return self.hub.switch_to(self.other.peak, self.other, item)
+    def send_many(self, items, timeout=-1):
+        """
+        Sends all of *items* on this pair in a single rendezvous, blocking
+        until they have all been received, either forever or until *timeout*
+        milliseconds. On timeout, items not yet received are dropped.
+
+        While we're blocked, recvers take the items straight from the batch
+        without switching to us, so a `recv_batch` takes many items for the
+        cost of one handoff.
+        """
+        middle = self.middle
+        if middle.pending is not None:
+            # another of this end's green threads has a batch in flight
+            for item in items:
+                self.send(item, timeout=timeout)
+            return
+
+        pending = collections.deque(items)
+        middle.pending = pending
+        try:
+            while pending:
+                if middle.closed:
+                    raise vanilla.exception.Closed
+                other = middle.recver()
+                if other is None:
+                    raise vanilla.exception.Abandoned
+
+                target = other.peak
+                if target is None:
+                    other = None
+                    self.pause(timeout=timeout)
+                    other = middle.recver()
+                    target = other.peak
+
+                # a recver only switches to us to take the last item
+                item = pending.popleft()
+                if isinstance(item, Exception):
+                    middle.hub.throw_to(target, item)
+                    continue
+                middle.hub.resume_later()
+                target.switch(other, item)
+        finally:
+            middle.pending = None
 
     def clear(self):
         self.send(NoState)
 
+    def trigger(self):
+        """
+        Sends True; see `Hub.trigger`.
+        """
+        self.send(True)
+
     def connect(self, recver):
         """
         Rewire:
@@ -275,6 +390,11 @@ class Sender(End):
         m2 = self.middle
         r2 = self.other
 
+        if type(m1) is not type(m2):
+            # r2 only works on the kind of middle it was made for
+            forward(self.hub, r1, s2)
+            return r2
+
         r2.middle = m1
         del m2.sender
         del m2.recver
@@ -295,7 +415,7 @@ class Sender(End):
 
 
 class Recver(End):
-    __slots__ = ['middle', 'downstream']
+    __slots__ = ['downstream']
 
     @property
     def current(self):
@@ -309,20 +429,71 @@ class Recver(End):
     def other(self):
         return self.middle.sender()
 
+    @property
+    def ready(self):
+        if self.middle.closed:
+            raise vanilla.exception.Closed
+        other = self.other
+        if other is None:
+            raise vanilla.exception.Abandoned
+        return other.peak is not None or bool(self.middle.pending)
+
     def recv(self, timeout=-1):
         """
         Receive and item from our Sender. This will block unless our Sender is
         ready, either forever or unless *timeout* milliseconds.
         """
-        if self.ready:
+        middle = self.middle
+        if middle.closed:
+            raise vanilla.exception.Closed
+        other = middle.sender()
+        if other is None:
+            raise vanilla.exception.Abandoned
+
+        target = other.peak
+
+        # take from a send_many's batch without switching. if the sender is
+        # blocked, the last item is left for it to hand over, which wakes it
+        pending = middle.pending
+        if pending and (target is None or len(pending) > 1):
+            item = pending.popleft()
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        if target is not None:
             self.select()
             # switch directly, as we need to pause
-            _, ret = self.other.peak.switch(self.other, None)
+            _, ret = target.switch(other, None)
             self.unselect()
             return ret
 
+        # don't hold our Sender while we wait, so that it can still be
+        # abandoned
+        other = None
         return self.pause(timeout=timeout)
 
+    def recv_batch(self, max_items, timeout=-1):
+        """
+        Receives a list of up to *max_items* items. This blocks for the first
+        item, either forever or until *timeout* milliseconds, and then takes
+        as many more as were sent alongside it with `send_many`, without
+        blocking again::
+
+            h.spawn(sender.send_many, [1, 2, 3])
+            recver.recv_batch(10) # returns [1, 2, 3]
+
+        An exception sent in a batch is raised by the following call.
+        """
+        batch = [self.recv(timeout=timeout)]
+        pending = self.middle.pending
+        while pending and len(batch) < max_items:
+            if isinstance(pending[0], Exception):
+                break
+            batch.append(self.recv())
+            pending = self.middle.pending
+        return batch
+
     def __iter__(self):
         while True:
             try:
@@ -389,7 +560,7 @@ class Recver(End):
         else:
             return target.connect(self)
 
-    def map(self, f):
+    def map(self, f, fuse=True):
         """
         *f* is a callable that takes a single argument. All values sent on this
         Recver's Sender will be passed to *f* to be transformed::
@@ -398,18 +569,72 @@ class Recver(End):
                 return i * 2
 
             sender, recver = h.pipe()
-            recver.map(double)
+            recver = recver.map(double)
 
             h.spawn(sender.send, 2)
             recver.recv() # returns 4
+
+        Chained map, `filter` and `flat_map` stages are fused: they're run
+        together, on a single green thread, as one stage. Pass *fuse=False*
+        to start a new stage on its own green thread instead, e.g. so that a
+        stage which blocks can overlap with the stages before it.
+
+        If *f* raises an exception, it's sent on in place of the item.
+        """
+        return Fused(self, Fused.MAP, f, fuse)
+
+    def filter(self, f, fuse=True):
+        """
+        Only passes on the values for which *f* returns true; see `map`::
+
+            recver = recver.filter(lambda i: i % 2)
+        """
+        return Fused(self, Fused.FILTER, f, fuse)
+
+    def flat_map(self, f, fuse=True):
+        """
+        *f* returns an iterable for each value, and each of the items it
+        yields are passed on in turn; see `map`::
+
+            recver = recver.flat_map(lambda line: line.split())
+        """
+        return Fused(self, Fused.FLAT_MAP, f, fuse)
+
+    def batch(self, max_items, max_ms):
+        """
+        Collects the values sent on this Recver into lists. A list is passed
+        on once it has *max_items* items, or once its first item has waited
+        *max_ms* milliseconds, whichever is first, so sinks which are cheaper
+        in bulk can be fed in bulk, while latency stays bounded::
+
+            @recver.batch(100, 10).consume
+            def _(rows):
+                db.insert_many(rows)
+
+        There's a single timer for each list, rather than one for each item.
         """
         @self.pipe
-        def recver(recver, sender):
-            for item in recver:
-                try:
-                    sender.send(f(item))
-                except Exception, e:
-                    sender.send(e)
+        def recver(upstream, downstream):
+            Batch(upstream, downstream, max_items, max_ms).run()
+        return recver
+
+    def map_concurrent(self, f, concurrency=8, ordered=True):
+        """
+        Like `map`, but up to *concurrency* calls to *f* are run at once, each
+        on its own green thread, so a transform which blocks, e.g. on a
+        request to another service, doesn't hold up the items behind it::
+
+            recver = urls.map_concurrent(fetch, concurrency=32)
+
+        With *ordered* the results are passed on in the order their items
+        arrived, otherwise in the order they complete. A slot is freed once
+        its result has been passed on, so at most *concurrency* items are in
+        flight or waiting to be reordered, and items aren't taken from this
+        Recver while every slot is busy.
+        """
+        @self.pipe
+        def recver(upstream, downstream):
+            Concurrent(upstream, downstream, f, concurrency, ordered).run()
         return recver
 
     def consume(self, f):
@@ -439,7 +664,215 @@ class Recver(End):
                     break
 
 
-def Queue(hub, size):
+class Fused(object):
+    """
+    A chain of map, filter and flat_map stages, which is run by a single green
+    thread.
+
+    Mapping the chain's Recver again, before the chain has taken its first
+    item, fuses the new stage onto the chain. A new Recver is returned for the
+    longer chain, and the chain's green thread sends to it, in place of the
+    old Recver, just as a new stage would have taken everything sent to the
+    old one. Once the chain has taken an item, mapping it starts a new chain
+    instead, so that an item already in flight doesn't skip a stage.
+    """
+    MAP, FILTER, FLAT_MAP = range(3)
+
+    class Recver(Recver):
+        __slots__ = ['chain']
+
+        @property
+        def stages(self):
+            return self.chain.stages
+
+    class Chain(object):
+        """what the chain's green thread runs each item through"""
+        __slots__ = ['sender', 'stages', 'taken']
+
+        def __init__(self, sender, stages):
+            self.sender = sender
+            self.stages = stages
+            self.taken = False
+
+    def __new__(cls, recver, kind, f, fuse=True):
+        sender, fused = Pipe(recver.hub, recver=Fused.Recver)
+
+        chain = fuse and type(recver) is Fused.Recver and recver.chain
+        if chain and not chain.taken:
+            # the chain's green thread carries on with the new Recver. the
+            # old one keeps its stages, but won't be sent to again
+            upstream = chain.sender.upstream
+            recver.chain = Fused.Chain(None, chain.stages)
+            recver.chain.taken = True
+            chain.sender = sender
+            chain.stages = chain.stages + [(kind, f)]
+            fused.chain = chain
+        else:
+            upstream = recver
+            fused.chain = chain = Fused.Chain(sender, [(kind, f)])
+            recver.hub.spawn(Fused.run, recver, chain)
+
+        # link the two ends, as Recver.pipe does
+        upstream.downstream = sender
+        sender.upstream = upstream
+        return fused
+
+    @staticmethod
+    def run(recver, chain):
+        def push(item, i):
+            while i < len(stages):
+                kind, f = stages[i]
+                i += 1
+                if kind == Fused.MAP:
+                    item = f(item)
+                elif kind == Fused.FILTER:
+                    if not f(item):
+                        return
+                else:
+                    for item in f(item):
+                        push(item, i)
+                    return
+            sender.send(item)
+
+        try:
+            for item in recver:
+                # the chain can't be extended once it has taken an item
+                chain.taken = True
+                stages, sender = chain.stages, chain.sender
+                try:
+                    push(item, 0)
+                except vanilla.exception.Halt:
+                    raise
+                except Exception, e:
+                    sender.send(e)
+        except vanilla.exception.Halt:
+            pass
+        chain.sender.close()
+        recver.close()
+
+
+class Batch(object):
+    """
+    Collects a Recver's values into lists; see `Recver.batch`.
+    """
+    def __init__(self, upstream, downstream, max_items, max_ms):
+        self.hub = upstream.hub
+        self.upstream = upstream
+        self.downstream = downstream
+        self.max_items = max_items
+        self.max_ms = max_ms
+        self.collector = None
+        self.waiting = False
+        self.expired = False
+
+    def expire(self):
+        # if the collector is blocked on the upstream, interrupt its recv as
+        # though it had timed out
+        self.expired = True
+        if self.waiting:
+            self.hub.throw_to(
+                self.collector, vanilla.exception.Timeout('batch expired'))
+
+    def collect(self, batch):
+        self.expired = False
+        timer = self.hub.spawn_later(self.max_ms, self.expire)
+        try:
+            while len(batch) < self.max_items and not self.expired:
+                self.waiting = True
+                try:
+                    batch.extend(self.upstream.recv_batch(
+                        self.max_items - len(batch)))
+                except vanilla.exception.Timeout:
+                    break
+                finally:
+                    self.waiting = False
+        finally:
+            timer.cancel()
+
+    def run(self):
+        self.collector = getcurrent()
+        while True:
+            batch = self.upstream.recv_batch(self.max_items)
+            try:
+                self.collect(batch)
+            except vanilla.exception.Halt:
+                # pass on what we have before passing on the halt
+                self.downstream.send(batch)
+                raise
+            self.downstream.send(batch)
+
+
+class Concurrent(object):
+    """
+    Runs a map on many green threads at once; see `Recver.map_concurrent`.
+    """
+    def __init__(self, upstream, downstream, f, concurrency, ordered):
+        self.hub = upstream.hub
+        self.upstream = upstream
+        self.downstream = downstream
+        self.f = f
+        self.ordered = ordered
+        # a token for each free slot
+        self.slots = self.hub.queue(concurrency)
+        self.slots.send_many([None] * concurrency)
+        # (sequence, result) from each call, and finally (None, total)
+        self.results = self.hub.channel(concurrency)
+
+    def dispatch(self):
+        seq = 0
+        try:
+            while True:
+                self.slots.recv()
+                item = self.upstream.recv()
+                self.hub.spawn(self.call, seq, item)
+                seq += 1
+        except vanilla.exception.Halt:
+            pass
+        try:
+            self.results.send((None, seq))
+        except vanilla.exception.Halt:
+            pass
+
+    def call(self, seq, item):
+        try:
+            result = self.f(item)
+        except Exception, e:
+            result = e
+        try:
+            self.results.send((seq, result))
+        except vanilla.exception.Halt:
+            pass
+
+    def run(self):
+        self.hub.spawn(self.dispatch)
+        # results which have arrived ahead of their turn
+        waiting = {}
+        sent = 0
+        total = None
+        try:
+            while total is None or sent < total:
+                seq, result = self.results.recv()
+                if seq is None:
+                    total = result
+                    continue
+                if not self.ordered:
+                    seq = sent
+                waiting[seq] = result
+                while sent in waiting:
+                    self.downstream.send(waiting.pop(sent))
+                    sent += 1
+                    self.slots.send(None)
+        except vanilla.exception.Halt:
+            self.upstream.close()
+            raise
+        finally:
+            # stops the dispatcher, and any calls still running
+            self.slots.close()
+            self.results.close()
+        self.downstream.close()
+
+
+class Queue(Pipe):
     """
     ::
 
@@ -458,58 +891,532 @@ def Queue(hub, size):
         # q.send(1)    # this would deadlock however as the queue only has a
                        # buffer size of 1
         q.recv()       # returns 1
+
+    The buffer is held by the Queue's ends directly, so sends and recvs
+    complete without a switch until the buffer is full or empty. If the
+    sender is closed or abandoned, the recver can still drain what's left in
+    the buffer.
     """
-    assert size > 0
+    __slots__ = ['size', 'items', 'woken']
 
-    def main(upstream, downstream, size):
-        queue = collections.deque()
+    class Sender(Sender):
+        __slots__ = []
 
-        while True:
-            if downstream.halted:
-                # no one is downstream, so shutdown
-                upstream.close()
+        @property
+        def ready(self):
+            middle = self.middle
+            if middle.closed:
+                raise vanilla.exception.Closed
+            other = middle.recver()
+            if other is None:
+                raise vanilla.exception.Abandoned
+            return len(middle.items) < middle.size or other.peak is not None
+
+        def unselect(self):
+            # a recver which makes room wakes us by clearing current itself.
+            # if we were resumed by something else first, there's nothing to
+            # take back; the room is still there
+            current = getcurrent()
+            if self.middle.sender_current is current:
+                self.middle.sender_current = None
                 return
+            wake = self.middle.woken.pop(current, None)
+            if wake is not None:
+                wake.cancel()
 
-            watch = []
-            if queue:
-                watch.append(downstream)
-            else:
-                # if the buffer is empty, and no one is upstream, shutdown
-                if upstream.halted:
-                    downstream.close()
+        def send(self, item, timeout=-1):
+            middle = self.middle
+            items = middle.items
+            while True:
+                if middle.closed:
+                    raise vanilla.exception.Closed
+                other = middle.recver()
+                if other is None:
+                    raise vanilla.exception.Abandoned
+
+                # a recver only waits on an empty buffer. hand it the item
+                # to be resumed with, and carry on without switching
+                if not items:
+                    target = other.peak
+                    if target is not None:
+                        if isinstance(item, Exception):
+                            return middle.hub.throw_to(target, item)
+                        middle.recver_current = None
+                        middle.woken[target] = middle.hub.wake(
+                            target, other, item)
+                        return
+
+                if len(items) < middle.size:
+                    items.append(item)
                     return
 
-            # if are upstream is still available, and there is spare room in
-            # the buffer, watch upstream as well
-            if not upstream.halted and len(queue) < size:
-                watch.append(upstream)
+                other = None
+                Queue.wait(self, timeout)
+
+        def send_many(self, items, timeout=-1):
+            for item in items:
+                self.send(item, timeout=timeout)
 
+        def connect(self, recver):
+            forward(self.hub, recver, self)
+            return self.other
+
+    class Recver(Recver):
+        __slots__ = []
+
+        def unselect(self):
+            # a sender wakes us by clearing current itself. if we were
+            # resumed by something else before its wake ran, such as another
+            # end in a select, or a timeout, its item goes back in the buffer
+            current = getcurrent()
+            middle = self.middle
+            if middle.recver_current is current:
+                middle.recver_current = None
+                return
+            wake = middle.woken.pop(current, None)
+            if wake is not None and wake.cancel():
+                middle.items.appendleft(wake.args[1])
+
+        @property
+        def ready(self):
+            middle = self.middle
+            if middle.items:
+                return True
+            if middle.closed:
+                raise vanilla.exception.Closed
+            if middle.sender() is None:
+                raise vanilla.exception.Abandoned
+            return False
+
+        def recv(self, timeout=-1):
+            middle = self.middle
+            items = middle.items
+            if items:
+                item = items.popleft()
+                self.made_room()
+                if isinstance(item, Exception):
+                    raise item
+                return item
+
+            if middle.closed:
+                raise vanilla.exception.Closed
+            if middle.sender() is None:
+                raise vanilla.exception.Abandoned
+            _, item = Queue.wait(self, timeout)
+            return item
+
+        def recv_batch(self, max_items, timeout=-1):
+            batch = [self.recv(timeout=timeout)]
+            items = self.middle.items
+            while items and len(batch) < max_items:
+                if isinstance(items[0], Exception):
+                    break
+                batch.append(items.popleft())
+            self.made_room()
+            return batch
+
+        def made_room(self):
+            # wake a sender blocked on a full buffer, without switching
+            middle = self.middle
+            target = middle.sender_current
+            if target is not None:
+                middle.sender_current = None
+                middle.woken[target] = middle.hub.wake(
+                    target, middle.sender(), None)
+
+        def close(self, exception=vanilla.exception.Closed):
+            # no one is left to drain the buffer
+            self.middle.items.clear()
+            super(Queue.Recver, self).close(exception=exception)
+
+    @staticmethod
+    def wait(end, timeout):
+        # the other end wakes us by clearing end's current and queuing us to
+        # be resumed with `Hub.wake`, rather than switching to us. if we time
+        # out first, unselect takes the wake back
+        end.select()
+        try:
+            return end.hub.pause(timeout=timeout)
+        finally:
+            end.unselect()
+
+    def __new__(cls, hub, size):
+        assert size > 0
+        # subclasses, such as a `Broadcast`_'s subscriptions, bring their own
+        # ends
+        pair = super(Queue, cls).__new__(
+            cls, hub, sender=cls.Sender, recver=cls.Recver)
+        middle = pair.sender.middle
+        middle.size = size
+        middle.items = collections.deque()
+        # the green threads woken by the other end, which haven't run yet
+        middle.woken = {}
+        return pair
+
+
+def forward(hub, recver, sender):
+    """
+    Spawns a green thread which forwards everything from *recver* to
+    *sender*, until either end is halted. It's used to connect ends which
+    can't simply be rewired onto each other.
+    """
+    @hub.spawn
+    def _():
+        while True:
             try:
-                ch, item = hub.select(watch)
+                # only take an item once it can be passed straight on, so
+                # nothing is held in between
+                hub.select([sender])
+                sender.send(recver.recv())
             except vanilla.exception.Halt:
-                continue
+                break
+        sender.close()
+        recver.close()
+
+
+class Waiters(object):
+    """
+    A first come first served queue of the green threads waiting on an end,
+    each with an item. Green threads are added and removed in O(1), so that
+    selects and timeouts stay cheap with many waiters.
 
-            if ch == upstream:
-                queue.append(item)
+    A removed waiter's entry is left in the queue, marked dead, and skipped
+    when it reaches the front. The queue is compacted once most of it is
+    dead.
+    """
+    __slots__ = ['queue', 'entries']
 
-            elif ch == downstream:
-                item = queue.popleft()
-                downstream.send(item)
+    def __init__(self):
+        # [green thread, item] entries, in the order they were added
+        self.queue = collections.deque()
+        # maps each green thread to its live entry
+        self.entries = {}
 
-    upstream = hub.pipe()
-    downstream = hub.pipe()
+    def __len__(self):
+        return len(self.entries)
 
-    # TODO: rethink this
-    old_connect = upstream.sender.connect
+    def __contains__(self, target):
+        return target in self.entries
 
-    def connect(recver):
-        old_connect(recver)
-        return downstream.recver
+    def __iter__(self):
+        return (entry[0] for entry in self.queue if entry[0] is not None)
 
-    upstream.sender.connect = connect
+    def append(self, target, item=None):
+        entry = [target, item]
+        self.entries[target] = entry
+        self.queue.append(entry)
 
-    hub.spawn(main, upstream.recver, downstream.sender, size)
-    return Pair(upstream.sender, downstream.recver)
+    def remove(self, target):
+        """
+        Removes *target*, if it's still waiting.
+        """
+        entry = self.entries.pop(target, None)
+        if entry is None:
+            return
+        entry[0] = None
+        if len(self.queue) > 2 * len(self.entries) + 16:
+            self.queue = collections.deque(
+                entry for entry in self.queue if entry[0] is not None)
+
+    @property
+    def peak(self):
+        queue = self.queue
+        while queue:
+            target = queue[0][0]
+            if target is not None:
+                return target
+            queue.popleft()
+        return None
+
+    @property
+    def first(self):
+        """
+        The [green thread, item] at the front, or None.
+        """
+        return self.queue[0] if self.peak is not None else None
+
+    def popleft(self):
+        """
+        Removes and returns the (green thread, item) at the front. There must
+        be one.
+        """
+        queue = self.queue
+        while True:
+            target, item = queue.popleft()
+            if target is not None:
+                del self.entries[target]
+                return target, item
+
+
+class Channel(Pipe):
+    """
+    ::
+
+        send --\    +---------+  /--> recv
+                +-> | Channel | -+
+        send --/    +---------+  \--> recv
+
+    A Channel can have many senders and many recvers. By default it is
+    unbuffered, but a buffer of *size* items can be given. They're
+    structurally equivalent to channels in Go::
+
+        h = vanilla.Hub()
+        c = h.channel(1)
+        c.send(1)            # buffered, so this doesn't block
+        h.spawn(c.send, 2)   # but this will, until there's a recver
+        c.recv() # returns 1
+        c.recv() # returns 2
+
+    The Channel keeps its own queues of green threads waiting to send and
+    waiting to recv, and every item is handed over in a single hop. When a
+    waiting green thread's turn comes, it's queued to be resumed with
+    `Hub.wake` rather than switched to, so neither side switches while the
+    other is ready.
+    """
+    __slots__ = ['size', 'items', 'woken']
+
+    class Selecting(object):
+        """marks a green thread in a select, rather than a send"""
+
+    class Sender(Sender):
+        __slots__ = []
+
+        @property
+        def ready(self):
+            middle = self.middle
+            if middle.closed:
+                raise vanilla.exception.Closed
+            if middle.recver() is None:
+                raise vanilla.exception.Abandoned
+            return bool(middle.recver_current) or \
+                len(middle.items) < middle.size
+
+        def select(self):
+            self.current.append(getcurrent(), Channel.Selecting)
+
+        def unselect(self):
+            # a recver which frees a slot for us wakes us. if something else
+            # resumed us first, the slot goes to the next sender instead
+            if Channel.unwait(self) is not None:
+                Channel.offer(self.middle)
+
+        @property
+        def peak(self):
+            return self.current.peak
+
+        def abandoned(self):
+            Channel.throw(self.hub, self.current, vanilla.exception.Abandoned)
+
+        def send(self, item, timeout=-1):
+            middle = self.middle
+            if middle.closed:
+                raise vanilla.exception.Closed
+            other = middle.recver()
+            if other is None:
+                raise vanilla.exception.Abandoned
+
+            # a recver only waits on an empty buffer. hand it the item to be
+            # resumed with, and carry on without switching
+            recvers = middle.recver_current
+            if recvers:
+                target, _ = recvers.popleft()
+                if isinstance(item, Exception):
+                    return middle.hub.throw_to(target, item)
+                middle.woken[target] = middle.hub.wake(target, other, item)
+                return
+
+            if len(middle.items) < middle.size:
+                middle.items.append(item)
+                return
+
+            other = None
+            middle.sender_current.append(getcurrent(), item)
+            try:
+                middle.hub.pause(timeout=timeout)
+            except vanilla.exception.Timeout:
+                # if a recver took our item just as we timed out, the send
+                # has been made
+                if Channel.unwait(self) is None:
+                    raise
+            finally:
+                Channel.unwait(self)
+
+        def send_many(self, items, timeout=-1):
+            for item in items:
+                self.send(item, timeout=timeout)
+
+        def connect(self, recver):
+            forward(self.hub, recver, self)
+            return self.other
+
+        def close(self, exception=vanilla.exception.Closed):
+            Channel.close(self, exception)
+            super(Channel.Sender, self).close(exception=exception)
+
+    class Recver(Recver):
+        __slots__ = []
+
+        @property
+        def ready(self):
+            middle = self.middle
+            if middle.items:
+                return True
+            if middle.closed:
+                raise vanilla.exception.Closed
+            if middle.sender() is None:
+                raise vanilla.exception.Abandoned
+            return bool(middle.sender_current)
+
+        def select(self):
+            self.current.append(getcurrent())
+
+        def unselect(self):
+            # a sender wakes us with its item. if something else resumed us
+            # first, such as another end in a select, or a timeout, the item
+            # goes to the next recver instead
+            wake = Channel.unwait(self)
+            if wake is not None:
+                Channel.restore(self.middle, wake.args[1])
+
+        @property
+        def peak(self):
+            return self.current.peak
+
+        def abandoned(self):
+            Channel.throw(self.hub, self.current, vanilla.exception.Abandoned)
+
+        def take(self, wait=False):
+            # takes the next item, from the buffer or a waiting sender, which
+            # is woken. returns NoState if there isn't one. each item taken
+            # frees one slot, and only one sender is woken for it. a
+            # selecting sender is woken to send itself, so if the buffer is
+            # empty, it's only woken if we'll *wait* for its send
+            middle = self.middle
+            items = middle.items
+            senders = middle.sender_current
+            if senders:
+                if not (items or wait) and \
+                        senders.first[1] is Channel.Selecting:
+                    return NoState
+                target, item = senders.popleft()
+                middle.woken[target] = middle.hub.wake(
+                    target, middle.sender(), None)
+                if item is Channel.Selecting:
+                    return items.popleft() if items else NoState
+                if items:
+                    items.append(item)
+                    return items.popleft()
+                return item
+            if items:
+                return items.popleft()
+            return NoState
+
+        def recv(self, timeout=-1):
+            middle = self.middle
+            item = self.take(wait=True)
+            if item is NoState:
+                if middle.closed:
+                    raise vanilla.exception.Closed
+                if middle.sender() is None:
+                    raise vanilla.exception.Abandoned
+                item = self.pause(timeout=timeout)
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+        def recv_batch(self, max_items, timeout=-1):
+            batch = [self.recv(timeout=timeout)]
+            items = self.middle.items
+            while len(batch) < max_items:
+                if items and isinstance(items[0], Exception):
+                    break
+                item = self.take()
+                if item is NoState:
+                    break
+                if isinstance(item, Exception):
+                    # a waiting sender's exception; leave it for next time
+                    items.appendleft(item)
+                    break
+                batch.append(item)
+            return batch
+
+        def close(self, exception=vanilla.exception.Closed):
+            # no one is left to drain the buffer
+            self.middle.items.clear()
+            Channel.close(self, exception)
+            super(Channel.Recver, self).close(exception=exception)
+
+    @staticmethod
+    def unwait(end):
+        # takes the current green thread off end's queue of waiters. the
+        # other end takes a green thread off the queue before waking it, and
+        # records the wake in woken. if it was resumed by something else
+        # before the wake ran, the wake is cancelled and returned
+        current = getcurrent()
+        end.current.remove(current)
+        wake = end.middle.woken.pop(current, None)
+        if wake is not None and wake.cancel():
+            return wake
+        return None
+
+    @staticmethod
+    def restore(middle, item):
+        # *item* was handed to a recver which didn't take it. it goes to the
+        # next waiting recver, or back to the front of the buffer
+        recvers = middle.recver_current
+        if recvers:
+            target, _ = recvers.popleft()
+            middle.woken[target] = middle.hub.wake(
+                target, middle.recver(), item)
+        else:
+            middle.items.appendleft(item)
+
+    @staticmethod
+    def offer(middle):
+        # a slot was freed for a selecting sender which didn't take it. it
+        # goes to the next waiting sender
+        senders = middle.sender_current
+        recvers = middle.recver_current
+        if not senders or not (recvers or len(middle.items) < middle.size):
+            return
+        target, item = senders.popleft()
+        middle.woken[target] = middle.hub.wake(target, middle.sender(), None)
+        if item is Channel.Selecting:
+            return
+        if recvers:
+            target, _ = recvers.popleft()
+            middle.woken[target] = middle.hub.wake(
+                target, middle.recver(), item)
+        else:
+            middle.items.append(item)
+
+    @staticmethod
+    def throw(hub, waiters, exception):
+        while waiters:
+            target, _ = waiters.popleft()
+            hub.throw_to(target, exception)
+
+    @staticmethod
+    def close(end, exception):
+        # everything waiting, on either side, is woken with *exception*.
+        # recvers only wait on an empty buffer, so there's nothing for them
+        # to drain
+        middle = end.middle
+        middle.closed = True
+        Channel.throw(middle.hub, middle.sender_current, exception)
+        Channel.throw(middle.hub, middle.recver_current, exception)
+
+    def __new__(cls, hub, size=0):
+        pair = super(Channel, cls).__new__(
+            cls, hub, sender=Channel.Sender, recver=Channel.Recver)
+        middle = pair.sender.middle
+        middle.size = max(size, 0)
+        middle.items = collections.deque()
+        middle.sender_current = Waiters()
+        middle.recver_current = Waiters()
+        # the green threads woken by either side, which haven't run yet
+        middle.woken = {}
+        return pair
 
 
 class Dealer(object):
@@ -534,6 +1441,8 @@ class Dealer(object):
         d.send(2)
     """
     class Recver(Recver):
+        __slots__ = []
+
         def select(self):
             assert getcurrent() not in self.current
             self.current.append(getcurrent())
@@ -543,7 +1452,7 @@ class Dealer(object):
 
         @property
         def peak(self):
-            return self.current[0]
+            return self.current.peak
 
         def abandoned(self):
             waiters = list(self.current)
@@ -551,9 +1460,8 @@ class Dealer(object):
                 self.hub.throw_to(current, vanilla.exception.Abandoned)
 
     def __new__(cls, hub):
-        sender, recver = hub.pipe()
-        recver.__class__ = Dealer.Recver
-        recver.current = collections.deque()
+        sender, recver = Pipe(hub, recver=Dealer.Recver)
+        recver.current = Waiters()
         return Pair(sender, recver)
 
 
@@ -579,6 +1487,8 @@ class Router(object):
         r.recv() # returns 1
     """
     class Sender(Sender):
+        __slots__ = []
+
         def select(self):
             assert getcurrent() not in self.current
             self.current.append(getcurrent())
@@ -588,7 +1498,7 @@ class Router(object):
 
         @property
         def peak(self):
-            return self.current[0]
+            return self.current.peak
 
         def abandoned(self):
             waiters = list(self.current)
@@ -597,40 +1507,135 @@ class Router(object):
 
         def connect(self, recver):
             self.onclose(recver.close)
-            recver.consume(self.send)
+
+            @self.hub.spawn
+            def _():
+                # forward whole batches, so a send_many upstream is passed on
+                # in a single handoff
+                while True:
+                    try:
+                        self.send_many(recver.recv_batch(64))
+                    except vanilla.exception.Halt:
+                        recver.close()
+                        break
 
     def __new__(cls, hub):
-        sender, recver = hub.pipe()
-        sender.__class__ = Router.Sender
-        sender.current = collections.deque()
+        sender, recver = Pipe(hub, sender=Router.Sender)
+        sender.current = Waiters()
         return Pair(sender, recver)
 
 
+# what Broadcast does with an item for a subscriber whose buffer is full
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+
+
 class Broadcast(object):
-    def __init__(self, hub):
+    """
+    ::
+
+                    +-----------+  /--> recv
+        send -->    | Broadcast | -+
+                    +-----------+  \\--> recv
+
+    A Broadcast sends every item to each of its subscribers. Each subscriber
+    has its own buffer of *size* items, so a subscriber which is a little
+    behind doesn't hold up the others. *policy* decides what happens when a
+    subscriber's buffer is full:
+
+        - BLOCK: the send blocks until the subscriber makes room
+        - DROP_OLDEST: the oldest item in the buffer is dropped
+        - DROP_NEWEST: the item being sent is dropped
+        - DISCONNECT: the subscriber is closed, once it has drained its
+          buffer, and unsubscribed
+
+    Both can be overridden for each subscriber::
+
+        h = vanilla.Hub()
+        b = h.broadcast(size=16)
+        s1 = b.subscribe()
+        s2 = b.subscribe(policy=vanilla.message.DROP_OLDEST)
+
+    A subscriber's Recver has a *lag*, the number of items waiting in its
+    buffer, and *dropped*, the number of items it has missed.
+    """
+    class Subscription(Queue):
+        __slots__ = ['policy', 'dropped']
+
+        class Sender(Queue.Sender):
+            __slots__ = []
+
+        class Recver(Queue.Recver):
+            __slots__ = []
+
+            @property
+            def lag(self):
+                return len(self.middle.items)
+
+            @property
+            def dropped(self):
+                return self.middle.dropped
+
+        def __new__(cls, hub, size, policy):
+            pair = super(Broadcast.Subscription, cls).__new__(cls, hub, size)
+            middle = pair.sender.middle
+            middle.policy = policy
+            middle.dropped = 0
+            return pair
+
+    def __init__(self, hub, size=1, policy=BLOCK):
+        assert size > 0
         self.hub = hub
-        self.subscribers = []
+        self.size = size
+        self.policy = policy
+        # an OrderedDict, so subscribers are sent to in the order they
+        # subscribed, but can unsubscribe in O(1)
+        self.subscribers = collections.OrderedDict()
         self.emptiers = []
 
     def onempty(self, f, *a, **kw):
         self.emptiers.append((f, a, kw))
 
     def send(self, item):
-        for subscriber in self.subscribers:
-            subscriber.send(item)
+        # subscribers may unsubscribe while we're sending
+        for sender in self.subscribers.keys():
+            middle = sender.middle
+            try:
+                if middle.policy == BLOCK or sender.ready:
+                    sender.send(item)
+                    continue
+            except vanilla.exception.Halt:
+                self.unsubscribe(sender)
+                continue
+
+            middle.dropped += 1
+            if middle.policy == DROP_OLDEST:
+                middle.items.popleft()
+                middle.items.append(item)
+            elif middle.policy == DISCONNECT:
+                # this runs our onclose, which unsubscribes
+                sender.close()
 
     def unsubscribe(self, sender):
-        self.subscribers.remove(sender)
+        if self.subscribers.pop(sender, None) is None:
+            return
         if not self.subscribers:
             emptiers = self.emptiers
             self.emptiers = []
             for f, a, kw in emptiers:
                 f(*a, **kw)
 
-    def subscribe(self):
-        sender, recver = self.hub.pipe()
+    def subscribe(self, size=None, policy=None):
+        """
+        Returns a new subscriber's `Recver`_. *size* and *policy* default to
+        the Broadcast's.
+        """
+        sender, recver = Broadcast.Subscription(
+            self.hub, size or self.size, policy or self.policy)
         recver.onclose(self.unsubscribe, sender)
-        self.subscribers.append(sender)
+        self.subscribers[sender] = True
         return recver
 
     def connect(self, recver):
@@ -638,38 +1643,179 @@ class Broadcast(object):
         recver.consume(self.send)
 
 
-def State(hub, state=NoState):
-    def main(recver, sender, state):
-        while True:
-            if state != NoState:
-                watch = [recver, sender]
-            else:
-                watch = [recver]
+class Value(object):
+    """
+    A Value holds the latest of a series of values, along with a *version*
+    which counts how many times it has been set. Reads don't block once a
+    value has been set, and any number of green threads can wait for it to
+    change, without a green thread of its own::
 
-            try:
-                ch, item = hub.select(watch)
-            except vanilla.Closed:
-                sender.close()
-                return
-            if ch == recver:
-                state = item
+        h = vanilla.Hub()
+        v = h.value()
+
+        h.spawn_later(10, v.set, 'Toby')
+        v.get()                  # returns 'Toby', after 10ms
+        v.get()                  # returns 'Toby' straight away
+
+        value, version = v.wait_changed(v.version)  # blocks until v.set
+    """
+    def __init__(self, hub, value=NoState):
+        self.hub = hub
+        self.value = value
+        self.version = 0
+        # green threads waiting for a change. each maps to None, or, for a
+        # select, the end it's selecting on
+        self.waiters = {}
+        # the waiters which have been woken, but haven't run yet
+        self.woken = {}
+
+    @property
+    def ready(self):
+        """
+        True if a value is set, and so `get` won't block.
+        """
+        return self.value is not NoState
+
+    def set(self, value):
+        """
+        Sets the current *value*, and wakes everything waiting for it to
+        change.
+        """
+        self.value = value
+        self.version += 1
+        waiters, self.waiters = self.waiters, {}
+        for target, end in waiters.iteritems():
+            if end is None:
+                self.woken[target] = self.hub.wake(
+                    target, (value, self.version))
+            elif value is NoState:
+                # a select is waiting for a value to recv
+                self.waiters[target] = end
             else:
-                sender.send(state)
+                self.woken[target] = self.hub.wake(target, end, value)
+
+    def clear(self):
+        """
+        Unsets the current value, so `get` will block until it's set again.
+        This is a change for `wait_changed`, but selects on a `State`_ carry
+        on waiting for the next value.
+        """
+        self.set(NoState)
+
+    def get(self, timeout=-1):
+        """
+        Returns the current value, blocking until one is set, either forever
+        or until *timeout* milliseconds.
+        """
+        while self.value is NoState:
+            self.wait_changed(self.version, timeout=timeout)
+        return self.value
+
+    def wait_changed(self, since_version, timeout=-1):
+        """
+        Blocks until the Value's version is no longer *since_version*, either
+        forever or until *timeout* milliseconds, and returns a tuple of the
+        (*value*, *version*) it was changed to. If it has already changed,
+        this returns straight away.
+        """
+        if self.version != since_version:
+            return self.value, self.version
+        current = getcurrent()
+        self.waiters[current] = None
+        try:
+            return self.hub.pause(timeout=timeout)
+        finally:
+            self.unwait(current)
+
+    def unwait(self, target):
+        # stops *target* waiting. if it was woken, but was resumed by
+        # something else before the wake ran, such as a timeout or another
+        # end in a select, the wake is cancelled
+        self.waiters.pop(target, None)
+        wake = self.woken.pop(target, None)
+        if wake is not None:
+            wake.cancel()
+
+    def throw(self, exception):
+        waiters, self.waiters = self.waiters, {}
+        for target in waiters:
+            self.hub.throw_to(target, exception)
+
+
+class State(Pipe):
+    """
+    A State is a `Pair`_ whose Recver always has the last item sent to the
+    Sender ready to be received. Sends never block, and recvs only block
+    until there's a first item, or if it has been cleared::
+
+        h = vanilla.Hub()
+        s = h.state()
+        s.send('Toby')
+        s.recv() # returns 'Toby'
+        s.recv() # returns 'Toby'
+
+    It's backed by a `Value`_, so reads don't involve any switching.
+    """
+    __slots__ = ['value']
+
+    class Sender(Sender):
+        __slots__ = []
+
+        @property
+        def ready(self):
+            if self.middle.closed:
+                raise vanilla.exception.Closed
+            return True
+
+        def send(self, item, timeout=-1):
+            if self.middle.closed:
+                raise vanilla.exception.Closed
+            self.middle.value.set(item)
+
+        def send_many(self, items, timeout=-1):
+            for item in items:
+                self.send(item)
+
+        def connect(self, recver):
+            forward(self.hub, recver, self)
+            return self.other
+
+        def close(self, exception=vanilla.exception.Closed):
+            super(State.Sender, self).close(exception=exception)
+            self.middle.value.throw(exception)
+
+    class Recver(Recver):
+        __slots__ = []
+
+        @property
+        def ready(self):
+            if self.middle.closed:
+                raise vanilla.exception.Closed
+            return self.middle.value.ready
 
-    upstream = hub.pipe()
-    downstream = hub.pipe()
+        def select(self):
+            self.middle.value.waiters[getcurrent()] = self
 
-    # TODO: rethink this
-    old_connect = upstream.sender.connect
+        def unselect(self):
+            self.middle.value.unwait(getcurrent())
 
-    def connect(recver):
-        old_connect(recver)
-        return downstream.recver
+        def recv(self, timeout=-1):
+            if self.middle.closed:
+                raise vanilla.exception.Closed
+            return self.middle.value.get(timeout=timeout)
 
-    upstream.sender.connect = connect
+        def recv_batch(self, max_items, timeout=-1):
+            return [self.recv(timeout=timeout)]
 
-    hub.spawn(main, upstream.recver, downstream.sender, state)
-    return Pair(upstream.sender, downstream.recver)
+        def close(self, exception=vanilla.exception.Closed):
+            super(State.Recver, self).close(exception=exception)
+            self.middle.value.throw(exception)
+
+    def __new__(cls, hub, state=NoState):
+        pair = super(State, cls).__new__(
+            cls, hub, sender=State.Sender, recver=State.Recver)
+        pair.sender.middle.value = Value(hub, state)
+        return pair
 
 
 class Stream(object):
@@ -679,6 +1825,13 @@ class Stream(object):
     descriptors.
     """
     class Recver(Recver):
+        __slots__ = ['extra', 'sep']
+
+        def __init__(self, pipe):
+            super(Stream.Recver, self).__init__(pipe)
+            self.extra = ''
+            self.sep = '\n'
+
         def recv(self, timeout=-1):
             if self.extra:
                 extra = self.extra
@@ -694,7 +1847,7 @@ class Stream(object):
             got = ''
             if n:
                 while len(got) < n:
-                    got += self.recv(timeout=timeout)
+                    got += ''.join(self.recv_batch(64, timeout=timeout))
                 got, self.extra = got[:n], got[n:]
             return got
 
@@ -705,7 +1858,7 @@ class Stream(object):
             """
             got = ''
             while True:
-                got += self.recv(timeout=timeout)
+                got += ''.join(self.recv_batch(64, timeout=timeout))
                 keep, matched, extra = got.partition(sep)
                 if matched:
                     self.extra = extra
@@ -720,7 +1873,183 @@ class Stream(object):
             return self.recv_partition(self.sep, timeout=timeout)
 
     def __new__(cls, recver, sep='\n'):
-        recver.__class__ = Stream.Recver
-        recver.extra = ''
+        # ends are slotted, so rather than changing recver's class, recver is
+        # piped to a Stream Recver, which then takes its place
+        if not isinstance(recver, Stream.Recver):
+            sender, stream = Pipe(recver.hub, recver=Stream.Recver)
+            recver = recver.pipe(sender)
         recver.sep = sep
         return recver
+
+
+class Selector(object):
+    """
+    A Selector is a persistent `Hub.select` over a set of ends, for a green
+    thread which multiplexes over many of them::
+
+        h = vanilla.Hub()
+        selector = h.selector(recvers)
+        while True:
+            end, item = selector.select()
+
+    Ends are registered once, when they're added, rather than on every
+    select. Each end has a watcher, a small green thread which waits on it in
+    our place, and which queues the end once it fires. A select only deals
+    with the ends which have fired since the last, so its cost is in the
+    number of ready ends, not the number of members.
+
+    As with `Hub.select`, a Recver is recv'd on by the select, and a Sender
+    is returned ready for a *send*, which should be made before selecting
+    again. Unlike `Hub.select`, an exception received on an end, including a
+    `Halt` when it's closed or abandoned, is returned as its *item* rather
+    than raised, so that one end doesn't interrupt the rest. Halted ends are
+    removed.
+    """
+    class Pending(object):
+        """marks an end which was already ready when it was armed"""
+
+    def __init__(self, hub, ends=()):
+        self.hub = hub
+        # maps each end to its watcher
+        self.members = {}
+        # (end, item) for each end which has fired
+        self.fired = collections.deque()
+        # ends which were returned by the last select, to be rearmed
+        self.taken = []
+        # the green thread waiting in a select, and its wake once an end
+        # fires
+        self.waiting = None
+        self.woken = None
+        for end in ends:
+            self.add(end)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, end):
+        return end in self.members
+
+    def add(self, end):
+        """
+        Adds *end* to the ends being selected over.
+        """
+        assert end not in self.members
+        self.members[end] = greenlet(self.watch, parent=self.hub.loop)
+        self.arm(end)
+
+    def remove(self, end):
+        """
+        Removes *end*, so that it can be used directly again.
+        """
+        watcher = self.members.pop(end)
+        if watcher:
+            # the watcher unregisters itself from end on the way out
+            watcher.parent = getcurrent()
+            watcher.throw()
+
+    def select(self, timeout=-1):
+        """
+        Blocks until one of our ends is ready, either forever or until
+        *timeout* milliseconds, and returns a tuple of (*end*, *item*). Ends
+        are returned in the order they became ready, and an end which is
+        ready again straight away goes to the back of the line, so a busy end
+        can't starve the others.
+        """
+        self.rearm()
+        while True:
+            if not self.fired:
+                self.wait(timeout)
+            got = self.take()
+            if got is not None:
+                return got
+
+    def select_all(self, timeout=-1):
+        """
+        Like `select`, but returns a list of (*end*, *item*) for every end
+        which is ready.
+        """
+        self.rearm()
+        ret = []
+        while not ret:
+            if not self.fired:
+                self.wait(timeout)
+            while self.fired:
+                got = self.take()
+                if got is not None:
+                    ret.append(got)
+        return ret
+
+    def arm(self, end):
+        # an end which is already ready won't fire, as whatever it's ready
+        # with is already waiting on it
+        try:
+            ready = end.ready
+        except vanilla.exception.Halt, e:
+            self.fired.append((end, e))
+            return
+        if ready:
+            self.fired.append((end, Selector.Pending))
+            return
+        watcher = self.members[end]
+        if watcher:
+            watcher.switch(getcurrent())
+        else:
+            # it's started the first time it's needed
+            watcher.switch(end, getcurrent())
+
+    def rearm(self):
+        taken, self.taken = self.taken, []
+        for end in taken:
+            if end in self.members:
+                self.arm(end)
+
+    def take(self):
+        end, item = self.fired.popleft()
+        if end not in self.members:
+            # it was removed after it fired
+            return None
+        if item is Selector.Pending:
+            item = None
+            if isinstance(end, Recver):
+                try:
+                    item = end.recv()
+                except Exception, e:
+                    item = e
+        if isinstance(item, vanilla.exception.Halt):
+            self.remove(end)
+        else:
+            self.taken.append(end)
+        return end, item
+
+    def watch(self, end, back):
+        # runs as end's watcher. it's parked in a select on end, in place of
+        # our selecting green thread, until end fires
+        while True:
+            end.select()
+            try:
+                _, item = back.switch()
+            except Exception, e:
+                item = e
+            finally:
+                end.unselect()
+
+            self.fired.append((end, item))
+            if self.waiting is not None:
+                target, self.waiting = self.waiting, None
+                self.woken = self.hub.wake(target)
+
+            # parked until rearmed, which passes us who to switch back to
+            back = self.hub.loop.switch()
+
+    def wait(self, timeout):
+        self.waiting = getcurrent()
+        try:
+            self.hub.pause(timeout=timeout)
+        finally:
+            # if we were resumed by something else before the wake ran, such
+            # as a timeout, the wake is cancelled. what fired is kept for the
+            # next select
+            self.waiting = None
+            woken, self.woken = self.woken, None
+            if woken is not None:
+                woken.cancel()
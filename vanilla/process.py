@@ -4,7 +4,6 @@ from __future__ import absolute_import
 import logging
 import select
 import signal
-import ctypes
 import sys
 import os
 
@@ -20,19 +19,33 @@ log = logging.getLogger(__name__)
 # Attempt to define a function  to ensure out children are sent a SIGTERM when
 # our process dies, to avoid orphaned children.
 
-def set_pdeathsig():
-    pass
+def pdeathsig():
+    return lambda: None
 
 if hasattr(select, 'epoll'):
-    try:
-        PR_SET_PDEATHSIG = 1
-        libc = ctypes.CDLL('libc.so.6')
+    PR_SET_PDEATHSIG = 1
+    # libc is loaded when the first child is launched, rather than on import
+    libc = None
+
+    def pdeathsig():
+        """
+        Returns a function to call in a forked child. This needs to be called
+        before forking, so libc is only loaded once, by the parent.
+        """
+        global libc
+        if libc is None:
+            try:
+                import ctypes
+                libc = ctypes.CDLL('libc.so.6')
+            except Exception:
+                log.warn('unable to load libc: needed to set PR_SET_PDEATHSIG')
+                libc = False
 
         def set_pdeathsig():
-            rc = libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
-            assert not rc, 'PR_SET_PDEATHSIG failed: %s' % rc
-    except:
-        log.warn('unable to load libc: needed to set PR_SET_PDEATHSIG')
+            if libc:
+                rc = libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+                assert not rc, 'PR_SET_PDEATHSIG failed: %s' % rc
+        return set_pdeathsig
 
 
 class __plugin__(object):
@@ -118,6 +131,7 @@ class __plugin__(object):
         if not stderrtoout:
             errpipe_r, errpipe_w = os.pipe()
 
+        set_pdeathsig = pdeathsig()
         pid = os.fork()
 
         if pid == 0:
@@ -1,15 +1,206 @@
 from __future__ import absolute_import
 
+import logging
+import select
 import signal
+import errno
+import os
+
+import vanilla.exception
+
+
+log = logging.getLogger(__name__)
+
+
+class Signal(int):
+    """
+    The signal number delivered to subscribers. It compares equal to the
+    plain signal number, and where the platform provides them, carries the
+    details of the signal's siginfo: *pid* and *uid* of the sender, *code*
+    and, for SIGCHLD, the child's exit *status*. Otherwise these are None.
+    """
+    pid = uid = code = status = None
+
+
+# On Linux, signals are blocked and read from a signalfd registered with the
+# Hub, instead of being handled preemptively and forwarded over a self pipe.
+# Python 2 doesn't expose pthread_sigmask or signalfd, so they're called
+# through libc. libc, and ctypes, are loaded by the first capture, so that
+# importing vanilla doesn't load them.
+#
+# The signal mask is inherited across fork and exec, so a child, e.g. one
+# started with subprocess, would otherwise start with these signals blocked,
+# and ignore them. load registers a fork handler which unblocks them in every
+# forked child: see reset.
+
+# whether signals are read from a signalfd
+signalfd = False
+
+# set by load
+libc = ctypes = sigset_t = signalfd_siginfo = atfork = None
+
+if hasattr(select, 'epoll'):
+    signalfd = True
+
+    SIG_BLOCK = 0
+    SIG_UNBLOCK = 1
+    SFD_NONBLOCK = os.O_NONBLOCK
+    SFD_CLOEXEC = 0o2000000
+
+    def load():
+        """
+        Loads libc, and registers reset to run in forked children. If
+        signalfd turns out not to be usable, signalfd is set to False, to fall
+        back to signal handlers.
+        """
+        global libc, ctypes, sigset_t, signalfd_siginfo, signalfd, atfork
+        if libc is not None:
+            return
+
+        try:
+            import ctypes
+            libc = ctypes.CDLL('libc.so.6', use_errno=True)
+
+            class sigset_t(ctypes.Structure):
+                _fields_ = [('val', ctypes.c_ulong * (
+                    1024 / (8 * ctypes.sizeof(ctypes.c_ulong))))]
+
+            class signalfd_siginfo(ctypes.Structure):
+                _fields_ = [
+                    ('ssi_signo', ctypes.c_uint32),
+                    ('ssi_errno', ctypes.c_int32),
+                    ('ssi_code', ctypes.c_int32),
+                    ('ssi_pid', ctypes.c_uint32),
+                    ('ssi_uid', ctypes.c_uint32),
+                    ('ssi_fd', ctypes.c_int32),
+                    ('ssi_tid', ctypes.c_uint32),
+                    ('ssi_band', ctypes.c_uint32),
+                    ('ssi_overrun', ctypes.c_uint32),
+                    ('ssi_trapno', ctypes.c_uint32),
+                    ('ssi_status', ctypes.c_int32),
+                    ('ssi_int', ctypes.c_int32),
+                    ('ssi_ptr', ctypes.c_uint64),
+                    ('ssi_utime', ctypes.c_uint64),
+                    ('ssi_stime', ctypes.c_uint64),
+                    ('ssi_addr', ctypes.c_uint64),
+                    ('pad', ctypes.c_uint8 * 48), ]
+
+            assert ctypes.sizeof(signalfd_siginfo) == 128
+
+            # check it works
+            os.close(open_signalfd(-1, []))
+
+            # Python 2 has no os.register_at_fork. the callback is kept
+            # referenced for as long as the process lives, as the handler
+            # can't be unregistered
+            atfork = ctypes.CFUNCTYPE(None)(reset)
+            # glibc's pthread_atfork is a static stub for this
+            if hasattr(libc, '__register_atfork'):
+                rc = libc.__register_atfork(None, None, atfork, None)
+            else:
+                rc = libc.pthread_atfork(None, None, atfork)
+            if rc:
+                raise OSError(rc, 'pthread_atfork failed')
+        except Exception:
+            log.warn('unable to use signalfd: falling back to signal handlers')
+            libc = False
+            signalfd = False
+
+    def sigset(signals):
+        mask = sigset_t()
+        libc.sigemptyset(ctypes.byref(mask))
+        for sig in signals:
+            libc.sigaddset(ctypes.byref(mask), sig)
+        return mask
+
+    def sigmask(how, *signals):
+        mask = sigset(signals)
+        if libc.pthread_sigmask(how, ctypes.byref(mask), None):
+            raise OSError(ctypes.get_errno(), 'pthread_sigmask failed')
+        return mask
+
+    def open_signalfd(fd, signals):
+        mask = sigset(signals)
+        fd = libc.signalfd(fd, ctypes.byref(mask), SFD_NONBLOCK | SFD_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'signalfd failed')
+        return fd
+
+
+# the number of Hubs which have each signal blocked for their signalfd. the
+# signal mask is per process, so a signal is only unblocked once the last of
+# them is done with it
+blocked = {}
+
+
+def block(sig):
+    if sig not in blocked:
+        sigmask(SIG_BLOCK, sig)
+        blocked[sig] = 0
+    blocked[sig] += 1
+
+
+def unblock(sig):
+    if sig not in blocked:
+        # reset, in a forked child
+        return
+    blocked[sig] -= 1
+    if blocked[sig]:
+        return
+    del blocked[sig]
+    # a signal which arrived after the last signalfd for it was closed is
+    # still pending, and would be delivered with its default action as soon
+    # as it's unblocked. no one is listening for it, so drop it
+    drain(sig)
+    sigmask(SIG_UNBLOCK, sig)
+
+
+def drain(sig):
+    fd = open_signalfd(-1, [sig])
+    try:
+        while os.read(fd, ctypes.sizeof(signalfd_siginfo) * 64):
+            pass
+    except OSError, e:
+        if e.errno != errno.EAGAIN:
+            raise
+    finally:
+        os.close(fd)
+
+
+def reset():
+    """
+    Unblocks every signal blocked to be read from a signalfd. The signal mask
+    is inherited across fork and exec, so this is run in every forked child,
+    by the fork handler registered when signalfd is first used. A forked
+    child's copy of the Hub no longer receives these signals.
+
+    Children which aren't started with fork, e.g. by posix_spawn or vfork,
+    don't run fork handlers. Pass preexec_fn=vanilla.signal.reset to
+    subprocess, or call this before exec, for those.
+    """
+    if blocked:
+        sigmask(SIG_UNBLOCK, *blocked)
+        blocked.clear()
 
 
 class __plugin__(object):
     def __init__(self, hub):
         self.hub = hub
         self.p = None
+        self.fd = None
+        # identifies the current signalfd's reader; a stale reader may still
+        # be finishing up after its signalfd was closed
+        self.reader = None
         self.mapper = {}
 
     def start(self):
+        if signalfd:
+            assert self.fd is None
+            self.fd = open_signalfd(-1, self.mapper.keys())
+            self.reader = object()
+            self.hub.spawn(self.read, self.fd, self.reader)
+            return
+
         assert not self.p
         self.p = self.hub.io.pipe()
 
@@ -18,14 +209,52 @@ class __plugin__(object):
             for data in self.p.recver:
                 for x in data:
                     sig = ord(x)
-                    self.mapper[sig].send(sig)
+                    self.mapper[sig].send(Signal(sig))
             self.p = None
 
+    def read(self, fd, reader):
+        size = ctypes.sizeof(signalfd_siginfo)
+        while self.reader is reader:
+            try:
+                # read as many pending signals as we can in one go
+                data = os.read(fd, size * 64)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    return
+                try:
+                    self.hub.wait_readable(fd)
+                except vanilla.exception.Halt:
+                    return
+                continue
+
+            for offset in xrange(0, len(data), size):
+                info = signalfd_siginfo.from_buffer_copy(data, offset)
+                sig = Signal(info.ssi_signo)
+                sig.pid = info.ssi_pid
+                sig.uid = info.ssi_uid
+                sig.code = info.ssi_code
+                sig.status = info.ssi_status
+                if sig in self.mapper:
+                    self.mapper[sig].send(sig)
+
     def injest(self, sig):
         if self.p:
             self.p.send(chr(sig))
 
     def capture(self, sig):
+        self.mapper[sig] = self.hub.broadcast()
+        self.mapper[sig].onempty(self.uncapture, sig)
+
+        if signalfd:
+            load()
+        if signalfd:
+            block(sig)
+            if self.fd is None:
+                self.start()
+            else:
+                open_signalfd(self.fd, self.mapper.keys())
+            return
+
         if not self.p:
             self.start()
 
@@ -35,14 +264,24 @@ class __plugin__(object):
             # means spawning needs to be atomic.
             self.hub.spawn(self.injest, sig)
 
-        self.mapper[sig] = self.hub.broadcast()
-        self.mapper[sig].onempty(self.uncapture, sig)
         signal.signal(sig, handler)
 
     def uncapture(self, sig):
         assert not self.mapper[sig].subscribers
-        signal.signal(sig, signal.SIG_DFL)
         del self.mapper[sig]
+
+        if signalfd:
+            if self.mapper:
+                open_signalfd(self.fd, self.mapper.keys())
+            else:
+                fd, self.fd = self.fd, None
+                self.reader = None
+                self.hub.unregister(fd)
+                os.close(fd)
+            unblock(sig)
+            return
+
+        signal.signal(sig, signal.SIG_DFL)
         if not self.mapper:
             self.p.close()
 
@@ -2,9 +2,18 @@ import socket
 import errno
 
 import vanilla.exception
+import vanilla.message
 import vanilla.poll
 
 
+class Server(vanilla.message.Recver):
+    """
+    A `Recver`_ of accepted connections, which also carries the *port* it's
+    listening on.
+    """
+    __slots__ = ['port']
+
+
 class __plugin__(object):
     def __init__(self, hub):
         self.hub = hub
@@ -32,8 +41,15 @@ class __plugin__(object):
             self.hub.unregister(sock.fileno())
             sock.close()
 
+        return self.serve(server, port)
+
+    def serve(self, recver, port):
+        """
+        Returns *recver* piped to a `Server` end for *port*.
+        """
+        sender, server = vanilla.message.Pipe(self.hub, recver=Server)
         server.port = port
-        return server
+        return recver.pipe(sender)
 
     def connect(self, port, host='127.0.0.1'):
         conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)